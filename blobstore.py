@@ -0,0 +1,174 @@
+"""Content-addressed storage for tile bodies, with blank tile detection."""
+
+import atexit
+import hashlib
+import io
+import json
+import os
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+from PIL import Image
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Only bodies this small are decoded to see if they are blank; a uniform
+# 256x256 tile compresses to well under this, a map tile never does.
+BLANK_MAX_BYTES = 4096
+
+
+@contextmanager
+def locked(lockfile: Path):
+    """Hold an exclusive lock on lockfile, between processes where possible."""
+    with open(lockfile, "a") as f:
+        if fcntl:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def digest(body: bytes | memoryview) -> str:
+    """Return the content hash a body is stored under."""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+
+def blank_colour(body: bytes | memoryview) -> tuple | None:
+    """Return the RGBA colour of a uniform tile, or None if it isn't one."""
+    if len(body) > BLANK_MAX_BYTES:
+        return None
+    with Image.open(io.BytesIO(body)) as im:
+        rgb = im.convert("RGB").getextrema()
+        alpha = im.convert("RGBA").getextrema()[3]
+    # Compare RGB as montage.paste() sees it, so transparent tiles match too.
+    if all(low == high for low, high in (*rgb, alpha)):
+        return tuple(low for low, _ in (*rgb, alpha))
+    return None
+
+
+class BlobStore:
+    """Store each distinct tile body once, hard-linked from its tile files.
+
+    Blobs live in a blobs/ directory beside the tiles, named by hash.
+    index.json lists the blank blobs and their colour, so the montage can
+    fill those tiles without decoding them: a tile is blank if its file is
+    a hard link to (shares an inode with) a blank blob. Other blobs are
+    only on disk, so the index stays small however big the job.
+
+    Several processes may share one store: temporary files are named per
+    process, and index.json is merged with what is on disk when saved.
+    It is saved now and then rather than per write, and at exit.
+    """
+
+    def __init__(self, tiledir: Path):
+        self.root = tiledir / "blobs"
+        self.root.mkdir(exist_ok=True)
+        self.index_file = self.root / "index.json"
+        self.lock_file = self.root / "index.lock"
+        self._lock = threading.Lock()
+        self._dirty = False
+        try:
+            index = json.loads(self.index_file.read_text())
+        except (OSError, ValueError):
+            index = {}
+        # Older indexes listed every blob, with None for non-blank ones.
+        self.index = {name: colour for name, colour in index.items() if colour}
+        self._blank_inodes = {}
+        for name, colour in self.index.items():
+            self._note_blank(self.root / name, colour)
+
+    def _note_blank(self, blob: Path, colour: list):
+        try:
+            self._blank_inodes[blob.stat().st_ino] = tuple(colour)
+        except OSError:
+            pass
+
+    def store(self, file: Path, body: bytes | memoryview):
+        """Write body to file, sharing storage with identical tiles."""
+        name = f"{digest(body)}{file.suffix}"
+        blob = self.root / name
+        with self._lock:
+            if not blob.exists():
+                part = blob.with_name(f"{name}.{os.getpid()}.part")
+                with open(part, "wb") as f:
+                    f.write(body)
+                try:
+                    # Never replace a blob, as tiles are already linked to it.
+                    os.link(part, blob)
+                except FileExistsError:
+                    pass  # Another process stored it first.
+                except OSError:
+                    part.replace(blob)
+                part.unlink(missing_ok=True)
+                try:
+                    colour = blank_colour(body)
+                except OSError:
+                    colour = None
+                if colour is not None:
+                    self.index[name] = colour
+                    self._dirty = True
+                    self._note_blank(blob, colour)
+        # Link beside the tile and rename, so nobody sees a partial tile.
+        part = file.with_name(f"{file.name}.{os.getpid()}.part")
+        part.unlink(missing_ok=True)
+        try:
+            os.link(blob, part)
+        except OSError:
+            # No hard links on this filesystem, so keep a private copy.
+            with open(part, "wb") as f:
+                f.write(body)
+        part.replace(file)
+
+    def colour(self, file: Path) -> tuple | None:
+        """Return the fill colour if file is a known blank tile."""
+        try:
+            return self._blank_inodes.get(file.stat().st_ino)
+        except OSError:
+            return None
+
+    def save(self):
+        """Write out index.json if any blank blobs were added."""
+        with self._lock:
+            if not self._dirty:
+                return
+            with locked(self.lock_file):
+                # Keep blobs other processes have added since we loaded it.
+                try:
+                    index = json.loads(self.index_file.read_text())
+                except (OSError, ValueError):
+                    index = {}
+                index.update(self.index)
+                self.index = index
+                part = self.index_file.with_name(f"{self.index_file.name}.part")
+                part.write_text(json.dumps(self.index))
+                part.replace(self.index_file)
+            self._dirty = False
+
+
+_stores: dict[Path, BlobStore] = {}
+_stores_lock = threading.Lock()
+
+
+def blob_store(tiledir: Path) -> BlobStore:
+    """Return the shared BlobStore for a tile directory."""
+    with _stores_lock:
+        if tiledir not in _stores:
+            _stores[tiledir] = BlobStore(tiledir)
+        return _stores[tiledir]
+
+
+@atexit.register
+def save_all():
+    """Save every store's index that has changed.
+
+    Stores whose tile directory has since been removed (e.g. a temporary
+    one) are dropped instead.
+    """
+    with _stores_lock:
+        for tiledir in [d for d, store in _stores.items() if not store.root.exists()]:
+            del _stores[tiledir]
+        stores = list(_stores.values())
+    for store in stores:
+        store.save()
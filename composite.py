@@ -0,0 +1,42 @@
+"""Blend tiles from several XYZ layers into one image."""
+
+import numpy as np
+from PIL import Image
+
+from blobstore import blob_store
+
+
+def _rgba(colour: tuple) -> tuple:
+    # Blob indexes written before alpha was recorded hold RGB only.
+    return colour if len(colour) == 4 else (*colour, 255)
+
+
+def blend(layers: list, size: tuple[int, int]) -> np.ndarray:
+    """Alpha-composite (file, opacity) tiles, bottom first, into RGB.
+
+    Known blank tiles are blended as a constant colour without decoding;
+    fully transparent ones are skipped altogether.
+    """
+    width, height = size
+    out = np.zeros((height, width, 3), dtype=np.float32)
+    for file, opacity in layers:
+        if not file.exists():
+            continue
+        colour = blob_store(file.parent).colour(file)
+        if colour is not None:
+            *rgb, alpha = _rgba(colour)
+            alpha = alpha / 255 * opacity
+            if alpha:
+                out += (np.array(rgb, dtype=np.float32) - out) * alpha
+            continue
+        with Image.open(file) as im:
+            rgba = np.asarray(im.convert("RGBA"), dtype=np.float32)
+        alpha = rgba[:height, :width, 3:] * (opacity / 255)
+        out += (rgba[:height, :width, :3] - out) * alpha
+    return np.rint(out).astype(np.uint8)
+
+
+def composite_cell(montage: Image.Image, cell: dict):
+    """Blend one grid cell's layer tiles and paste the result."""
+    pixels = blend(cell["layers"], cell["size"])
+    montage.paste(Image.fromarray(pixels), (cell["x"], cell["y"]))
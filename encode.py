@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""Encode output images, in parallel strips where the format allows."""
+
+import argparse
+import io
+import os
+import struct
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+# Tuned settings per format. jpeg and png split large images into strips
+# encoded on every core; the rest go through Pillow in one piece.
+FORMATS = {
+    "jpeg": {"format": "JPEG", "suffix": ".jpg", "quality": 90, "subsampling": 2},
+    "pjpeg": {
+        "format": "JPEG",
+        "suffix": ".jpg",
+        "quality": 90,
+        "progressive": True,
+        "optimize": True,
+    },
+    "webp": {"format": "WEBP", "suffix": ".webp", "quality": 85, "method": 4},
+    "png": {"format": "PNG", "suffix": ".png", "compress_level": 6},
+    "avif": {"format": "AVIF", "suffix": ".avif", "quality": 60, "speed": 6},
+    "jxl": {"format": "JXL", "suffix": ".jxl", "quality": 90},
+}
+
+SUFFIXES = {
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+    ".webp": "webp",
+    ".png": "png",
+    ".avif": "avif",
+    ".jxl": "jxl",
+}
+
+# Below this many pixels one core is quick enough.
+PARALLEL_PIXELS = 16_000_000
+
+# 4:2:0 JPEG is coded in 16x16 pixel blocks (MCUs).
+MCU = 16
+
+
+def available() -> list[str]:
+    """Return the formats this Pillow can write."""
+    Image.init()
+    return [name for name, fmt in FORMATS.items() if fmt["format"] in Image.SAVE]
+
+
+def _strips(height: int, step: int, workers: int) -> list[tuple[int, int]]:
+    """Cut height into about four strips per worker, multiples of step."""
+    rows = -(-height // step)
+    per_strip = max(1, -(-rows // (workers * 4)))
+    return [
+        (top, min(top + per_strip * step, height))
+        for top in range(0, height, per_strip * step)
+    ]
+
+
+def _jpeg_header(body: bytes) -> tuple[int, int]:
+    """Return the offsets of the SOF0 height and the end of the SOS header."""
+    offset, height_at = 2, None
+    while True:
+        marker = body[offset + 1]
+        length = struct.unpack(">H", body[offset + 2 : offset + 4])[0]
+        if marker == 0xC0:
+            height_at = offset + 5
+        if marker == 0xDA:
+            return height_at, offset + 2 + length
+        offset += 2 + length
+
+
+def encode_jpeg(image: Image.Image, options: dict, workers: int) -> bytes:
+    """Encode a baseline JPEG from strips encoded in parallel.
+
+    Each strip is a whole number of MCU rows, encoded on its own with the
+    same tables, so its entropy-coded data is exactly one restart interval
+    of the full image. The strips are joined with RST markers under the
+    first strip's header, its height patched and a DRI segment added.
+    """
+    width, height = image.size
+    mcus_per_row = -(-width // MCU)
+    strips = _strips(height, MCU, workers)
+    interval = mcus_per_row * (strips[0][1] - strips[0][0]) // MCU
+    if len(strips) == 1 or interval > 0xFFFF:
+        return _encode_whole(image, options)
+    options = {**options, "optimize": False, "progressive": False}
+
+    def strip(bounds: tuple[int, int]) -> bytes:
+        return _encode_whole(image.crop((0, bounds[0], width, bounds[1])), options)
+
+    with ThreadPoolExecutor(workers) as pool:
+        bodies = list(pool.map(strip, strips))
+
+    height_at, scan_at = _jpeg_header(bodies[0])
+    header = bytearray(bodies[0][:scan_at])
+    header[height_at : height_at + 2] = struct.pack(">H", height)
+    # Define the restart interval just before the SOS segment.
+    sos = bodies[0].rfind(b"\xff\xda", 0, scan_at)
+    header[sos:sos] = b"\xff\xdd" + struct.pack(">HH", 4, interval)
+    parts = [bytes(header)]
+    for index, body in enumerate(bodies):
+        if index:
+            parts.append(bytes((0xFF, 0xD0 + (index - 1) % 8)))
+        parts.append(body[_jpeg_header(body)[1] : -2])
+    parts.append(b"\xff\xd9")
+    return b"".join(parts)
+
+
+def _png_chunk(kind: bytes, data: bytes) -> bytes:
+    return (
+        struct.pack(">I", len(data))
+        + kind
+        + data
+        + struct.pack(">I", zlib.crc32(kind + data))
+    )
+
+
+def encode_png(image: Image.Image, options: dict, workers: int) -> bytes:
+    """Encode an RGB PNG, deflating strips in parallel.
+
+    Rows use the Up filter, so each strip can be filtered on its own from
+    the whole image. Each strip is deflated separately and ended with a
+    full flush, so they concatenate into one zlib stream, pigz-style.
+    """
+    pixels = np.asarray(image.convert("RGB"))
+    height, width = pixels.shape[:2]
+    level = options.get("compress_level", 6)
+
+    def strip(bounds: tuple[int, int]) -> tuple[bytes, np.ndarray]:
+        top, bottom = bounds
+        rows = pixels[top:bottom]
+        above = (
+            pixels[top - 1 : bottom - 1]
+            if top
+            else np.vstack(
+                [np.zeros((1, width, 3), np.uint8), pixels[: bottom - 1]],
+            )
+        )
+        filtered = np.empty((bottom - top, width * 3 + 1), np.uint8)
+        filtered[:, 0] = 2  # Up
+        filtered[:, 1:] = (rows - above).reshape(bottom - top, -1)
+        deflate = zlib.compressobj(level, zlib.DEFLATED, -15)
+        final = zlib.Z_FINISH if bottom == height else zlib.Z_FULL_FLUSH
+        return deflate.compress(filtered.tobytes()) + deflate.flush(final), filtered
+
+    strips = _strips(height, 1, workers)
+    with ThreadPoolExecutor(workers) as pool:
+        results = list(pool.map(strip, strips))
+    adler = 1
+    for _, filtered in results:
+        adler = zlib.adler32(filtered, adler)
+    stream = (
+        b"\x78\x9c" + b"".join(data for data, _ in results) + struct.pack(">I", adler)
+    )
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)),
+            _png_chunk(b"IDAT", stream),
+            _png_chunk(b"IEND", b""),
+        ],
+    )
+
+
+def _encode_whole(image: Image.Image, options: dict) -> bytes:
+    options = {key: value for key, value in options.items() if key != "suffix"}
+    buffer = io.BytesIO()
+    image.save(buffer, **options)
+    return buffer.getvalue()
+
+
+def encode(image: Image.Image, name: str, workers: int | None = None) -> bytes:
+    """Encode image in one of FORMATS."""
+    options = FORMATS[name]
+    workers = workers or os.cpu_count() or 1
+    parallel = workers > 1 and image.width * image.height >= PARALLEL_PIXELS
+    if parallel and name == "jpeg":
+        return encode_jpeg(image.convert("RGB"), options, workers)
+    if parallel and name == "png" and image.mode == "RGB":
+        return encode_png(image, options, workers)
+    return _encode_whole(image, options)
+
+
+def save_image(image: Image.Image, path: Path, name: str | None = None) -> dict:
+    """Save an output image with tuned settings, returning its size and time.
+
+    The format is taken from the suffix unless named; suffixes not in
+    FORMATS, or that this Pillow can't write, are left to Pillow.
+    """
+    path = Path(path)
+    if name is None:
+        name = SUFFIXES.get(path.suffix.lower())
+        if name not in available():
+            name = None
+    started_at = time.monotonic()
+    if name is None:
+        image.save(path)
+    else:
+        path.write_bytes(encode(image, name))
+    return {
+        "format": name or path.suffix,
+        "bytes": path.stat().st_size,
+        "seconds": time.monotonic() - started_at,
+    }
+
+
+def describe(report: dict) -> str:
+    """Summarise a save_image() or compare() report entry."""
+    return (
+        f"{report['format']}, {report['bytes'] / 2**20:.2f} MiB "
+        f"in {report['seconds']:.2f} s"
+    )
+
+
+def compare(image: Image.Image, names: list, workers: int | None = None) -> list:
+    """Encode image in each format in memory, returning size and time."""
+    report = []
+    for name in names:
+        started_at = time.monotonic()
+        try:
+            size = len(encode(image, name, workers))
+        except (OSError, ValueError) as e:
+            # e.g. WebP is limited to 16383 pixels a side.
+            print(f"{name}: {e}")
+            continue
+        report.append(
+            {
+                "format": name,
+                "bytes": size,
+                "seconds": time.monotonic() - started_at,
+            },
+        )
+    return report
+
+
+def main(source: Path, names: list, workers: int | None = None):
+    """Print the size and encoding time of an image in each format."""
+    Image.MAX_IMAGE_PIXELS = None
+    with Image.open(source) as im:
+        image = im.convert("RGB")
+    print(f"{source}: {image.width}x{image.height}")
+    for row in compare(image, names, workers):
+        print(describe(row))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="encode", usage="%(prog)s [options]")
+    parser.add_argument("image", help="Image to re-encode", type=Path)
+    parser.add_argument(
+        "--formats",
+        help="Formats to compare (default: all this Pillow can write)",
+        nargs="+",
+        choices=FORMATS,
+    )
+    parser.add_argument("--workers", help="Encoding threads", type=int)
+    args = parser.parse_args()
+    main(args.image, args.formats or available(), args.workers)
@@ -4,21 +4,38 @@
 import argparse
 import asyncio
 import json
+import math
+import os
 import re
+import socket
 import sys
 import time
+from functools import partial
 from pathlib import Path
 
-import aiofiles
 import geopandas as gpd
-import httpx
-import numpy as np
 import pandas as pd
-from PIL import Image
 from shapely.geometry import LineString, Point, Polygon
 
+from encode import describe, save_image
+from geotiff import bounds_transform, grid_pixels, write_geotiff
+from jobstore import JobStore, hold_lease
+from montage import build_montage
+from mosaic import RULES, build_mosaic, mosaic_grid, mosaic_pixels, sheet_year
+from schedule import ORDERS, Budget, order_grid
+from tilecache import MAX_REQUEUES, cache_tile, retryable
+from tiles import TileGrid, iiif_name, iiif_url
+from transport import BACKENDS, Transport
+from validators import validators
+
 QUEUE_SIZE = 16
 
+# Tiles are always fetched as JPEG, which every IIIF image server offers,
+# whatever format the maps are saved in.
+TILE_FORMAT = "jpg"
+
+INFO_PATTERN = r'https://.+info\.json'
+
 POLYGON = '''
 {
   "type": "FeatureCollection",
@@ -70,66 +87,160 @@ POLYGON = '''
 '''
 
 
-async def consumer(queue: asyncio.Queue, client: httpx.AsyncClient):
+async def consumer(
+    queue: asyncio.Queue,
+    client: Transport,
+    verify: bool = False,
+    budget: Budget | None = None,
+    refresh: bool = False,
+):
     """Process tiles from the queue."""
     while True:
         tile = await queue.get()
-        if not tile["file"].exists():
-            for retry in range(2):
-                r = await client.get(tile.get("url"))
-                if r.status_code == 200:
-                    if retry:
-                        sys.stderr.write("*")
-                    else:
-                        sys.stderr.write("#")
-                    async with aiofiles.open(tile["file"], mode="wb") as img:
-                        await img.write(r.content)
-                    break  # Exit from retry loop
-                else:
-                    sys.stderr.write("!")
-                    await asyncio.sleep(5)
-
-            sys.stderr.flush()
+        if budget and not budget.allow(tile):
+            sys.stderr.write(".")  # Out of time or requests, leave it missing
+        # Tiles shared between maps are only downloaded once.
+        elif not await cache_tile(
+            client,
+            tile,
+            retries=1,
+            verify=verify,
+            refresh=refresh,
+        ):
+            tile.requeues += 1
+            if tile.requeues <= MAX_REQUEUES and retryable(tile.error):
+                # Try it again once the rest of the queue has had a go.
+                queue.put_nowait(tile)
+            else:
+                sys.stderr.write("!")
+
+        sys.stderr.flush()
         queue.task_done()
 
 
-def tile_url(
-    base_url: str,
-    scale: int,
+async def resolve_map(client: Transport, map: dict) -> bool:
+    """Find a map's IIIF image and fetch its info.json.
+
+    A saved info.json is revalidated rather than fetched again.
+    """
+    print(f"Processing {map['viewer']}")
+    r = await client.get(map["viewer"])
+    imageurl = re.findall(INFO_PATTERN, r.text)[0]
+    print(f"Got imageurl: {imageurl}")
+    store = validators(map["infofile"].parent)
+    headers = store.conditions(map["infofile"]) if map["infofile"].exists() else {}
+    r = await client.get(imageurl, headers=headers)
+    if r.status_code == 304 and headers:
+        store.record(map["infofile"], r.headers)
+        map["image_data"] = json.loads(map["infofile"].read_text())
+        map["changed"] = False
+        return True
+    if r.status_code != 200:
+        print(f"Error fetching image info: {r.status_code}")
+        return False
+    map["image_data"] = r.json()
+    with open(map["infofile"], "w") as p:
+        p.write(json.dumps(map["image_data"]))
+    store.record(map["infofile"], r.headers)
+    map["changed"] = True
+    return True
+
+
+def enqueue_tiles(
+    queue: asyncio.Queue,
+    tmpdir: Path,
     img_type: str,
-    x: int,
-    y: int,
-    width: int,
-    height: int,
-) -> str:
-    """Generate the URL for a tile image."""
-    return (
-        f"{base_url}/"
-        f"{x},{y},{width},{height}/"
-        f"{width},{height}/{scale}/default.{img_type}"
+    map: dict,
+    order: str = "column",
+):
+    """Queue every tile of a map, recording them on the map for the montage."""
+    image_data = map["image_data"]
+    base_url = image_data.get("id", image_data.get("@id"))
+    path = base_url.split("/")[-1]
+    tile_width: int = image_data["tiles"][0]["width"]
+    tile_height: int = image_data["tiles"][0]["height"]
+    # Pick the smallest scale factor(usually 1x)
+    # This is to ensure we get the highest resolution tiles available
+    scale_factor: int = min(image_data["tiles"][0]["scaleFactors"])
+    # And pass the index of scale, as per the API.
+    scale: int = image_data["tiles"][0]["scaleFactors"].index(scale_factor)
+    map["width"] = image_data["width"]
+    map["height"] = image_data["height"]
+    map["tile_size"] = (tile_width, tile_height)
+    grid = TileGrid(
+        tmpdir,
+        (map["width"], map["height"]),
+        map["tile_size"],
+        partial(iiif_name, path, img_type),
+        partial(iiif_url, base_url, scale, img_type),
     )
 
+    columns = math.ceil(image_data["width"] / tile_width)
+    rows = math.ceil(image_data["height"] / tile_height)
+    map["tiles"] = grid.tiles(order_grid(columns, rows, order))
+    for tile in map["tiles"]:
+        queue.put_nowait(tile)
 
-def tile_filename(path: str, img_type: str, x: int, y: int) -> str:
-    """Generate the filename for a tile image."""
-    return f"{path}_{x}_{y}.{img_type}"
 
+def save_montage(map: dict):
+    """Assemble and save a map's montage."""
+    filename = map["filename"]
+    print(f"Creating montage {filename}")
+    montage = build_montage(map["width"], map["height"], map["tiles"])
+    report = save_image(montage, filename)
+    print(f"Montage saved to {filename}: {describe(report)}")
 
-async def main(geojson: Path, output_path: Path):
-    """Download IIF tiles and create a montage image."""
-    queue = asyncio.Queue()
 
-    mapsdir = Path("maps")
-    mapsdir.mkdir(exist_ok=True)
-    tmpdir = mapsdir / "tiles"
-    tmpdir.mkdir(exist_ok=True)
-    img_type = output_path.suffix
+def save_geotiff(map: dict):
+    """Write a map as a GeoTIFF, assuming the scan spans the sheet bounds."""
+    filename = map["filename"]
+    print(f"Creating GeoTIFF {filename}")
+    write_geotiff(
+        filename,
+        map["width"],
+        map["height"],
+        map["tile_size"],
+        grid_pixels(map["tiles"]),
+        bounds_transform(map["bounds"], map["width"], map["height"]),
+        4326,
+    )
+    print(f"GeoTIFF saved to {filename}")
+
+
+def save_mosaic(maps: list, output_path: Path, rule: str, geotiff: bool = False):
+    """Stitch every map into one image of the area in polygon.geojson."""
+    if not maps:
+        print("No sheets to mosaic")
+        return
+    bounds = tuple(gpd.read_file("polygon.geojson").total_bounds)
+    width, height, *_ = mosaic_grid(bounds, maps)
+    print(f"Creating {width}x{height} mosaic {output_path}, {rule} sheet on top")
+    if geotiff:
+        # Painted one output tile at a time as the GeoTIFF is written.
+        write_geotiff(
+            output_path,
+            width,
+            height,
+            (256, 256),
+            mosaic_pixels(bounds, maps, rule),
+            bounds_transform(bounds, width, height),
+            4326,
+        )
+        print(f"Mosaic saved to {output_path}")
+    else:
+        report = save_image(build_mosaic(bounds, maps, rule), output_path)
+        print(f"Mosaic saved to {output_path}: {describe(report)}")
+
+
+def find_maps(geojson: Path, mapsdir: Path, suffix: str) -> list:
+    """List the sheets in geojson that intersect polygon.geojson."""
     maps = []
 
     gdf = gpd.read_file(geojson)
     polygon = gdf.from_file("polygon.geojson")
     overlay = gdf.overlay(polygon, how="intersection")
-    pattern = r'https://.+info\.json'
+    # The overlay clips each sheet; the scans cover the whole sheet.
+    sheets = gdf.set_index("id").geometry
     for series in overlay.iterfeatures():
         # ow = overlay.iloc[series]
         properties = series.get("properties")
@@ -163,77 +274,216 @@ async def main(geojson: Path, output_path: Path):
             mapsdir
             / f"{properties['id'].split('_WFS')[0]}_{minx:.06f}_{miny:.06f}_{maxx:.06f}_{maxy:.06f}"
         )
-        filename = Path(f"{filebase}{img_type}")
+        filename = Path(f"{filebase}{suffix}")
         infofile = Path(f"{filebase}.json")
-        map = {"filename": filename, "geometry": geometry}
+        map = {
+            "filename": filename,
+            "infofile": infofile,
+            "geometry": geometry,
+            "viewer": viewerurl,
+            "bounds": sheets.loc[properties["id"]].bounds,
+            "year": sheet_year(properties.get("WFS_TITLE", "")),
+        }
         maps.append(map)
 
-        print(f"Processing {viewerurl}")
-        r = httpx.get(viewerurl)
-        imageurl = re.findall(pattern, r.text)[0]
-        print(f"Got imageurl: {imageurl}")
-        infojson = httpx.get(imageurl).json()
-        with open(infofile, "w") as p:
-            p.write(json.dumps(infojson))
-        if filename.exists():
-            print(f"Skipping existing {filename}")
+    return maps
+
+
+def pending_maps(maps: list, resolved: list, skip_existing: bool = True) -> list:
+    """Drop maps that failed to resolve or, optionally, are already saved."""
+    pending = []
+    for map, ok in zip(maps, resolved, strict=True):
+        if not ok:
             continue
-        async with httpx.AsyncClient(http2=True) as client:
-            r = await client.get(imageurl)
-            if r.status_code != 200:
-                print(f"Error fetching image info: {r.status_code}")
-                return
-            image_data = r.json()
-            base_url = image_data.get("id", image_data.get("@id"))
-            path = base_url.split("/")[-1]
-            tile_width: int = image_data["tiles"][0]["width"]
-            tile_height: int = image_data["tiles"][0]["height"]
-            # Pick the smallest scale factor(usually 1x)
-            # This is to ensure we get the highest resolution tiles available
-            scale_factor: int = min(image_data["tiles"][0]["scaleFactors"])
-            # And pass the index of scale, as per the API.
-            scale: int = image_data["tiles"][0]["scaleFactors"].index(scale_factor)
-            tiles = []
-            tasks = []
-
-            for _ in range(QUEUE_SIZE):
-                tasks.append(asyncio.create_task(consumer(queue, client)))
-
-            for x in range(0, image_data["width"], tile_width):
-                for y in range(0, image_data["height"], tile_height):
-                    tile = {"x": x, "y": y}
-                    # The right-most and bottom-most tiles need to be decreased
-                    # if they would exceed the size of the full image.
-                    this_tile_width = min(tile_width, image_data["width"] - x)
-                    this_tile_height = min(tile_height, image_data["height"] - y)
-                    tile["file"] = Path(tmpdir, tile_filename(path, img_type, x, y))
-                    tile["url"] = tile_url(
-                        base_url,
-                        scale,
-                        img_type,
-                        x,
-                        y,
-                        this_tile_width,
-                        this_tile_height,
-                    )
-                    tiles.append(tile)
-                    queue.put_nowait(tile)
-
-            await queue.join()
-
-            for task in tasks:
-                task.cancel()
-
-            await asyncio.gather(*tasks, return_exceptions=True)
-
-            print()
-            print(f"Creating montage {filename}")
-            montage = Image.new("RGB", (image_data["width"], image_data["height"]))
-            for tile in tiles:
-                with Image.open(tile["file"]) as im:
-                    montage.paste(im, (tile["x"], tile["y"]))
-            montage.save(filename)
-            print(f"Montage saved to {filename}")
+        if skip_existing and map["filename"].exists():
+            print(f"Skipping existing {map['filename']}")
+            continue
+        pending.append(map)
+    return pending
+
+
+def changed_maps(maps: list, output_path: Path | None = None) -> list:
+    """Drop maps whose info.json and tiles were all unchanged on refresh.
+
+    A map is kept if its image is missing, or output_path if given.
+    Tiles can be shared between maps, so any tile written for one map
+    counts as a change for all of them.
+    """
+    written = {tile.file for map in maps for tile in map["tiles"] if tile.written}
+    changed = []
+    for map in maps:
+        filename = output_path or map["filename"]
+        if (
+            map["changed"]
+            or not filename.exists()
+            or any(tile.file in written for tile in map["tiles"])
+        ):
+            changed.append(map)
+        elif not output_path:
+            print(f"Skipping unchanged {filename}")
+    return changed
+
+
+def save_map(map: dict):
+    """Save a map as a GeoTIFF or a montage, going by its filename."""
+    if map["filename"].suffix == ".tif":
+        save_geotiff(map)
+    else:
+        save_montage(map)
+
+
+async def fetch_maps(
+    maps: list,
+    tmpdir: Path,
+    backend: str = "httpx",
+    verify: bool = False,
+    order: str = "column",
+    budget: Budget | None = None,
+    skip_existing: bool = True,
+    refresh: bool = False,
+) -> list:
+    """Resolve maps and download their tiles, returning those fetched.
+
+    With refresh, cached tiles are revalidated rather than trusted.
+    """
+    queue = asyncio.Queue()
+
+    # One client and one set of workers for every map, so tiles shared
+    # between sheets are coalesced rather than fetched per map.
+    async with Transport(backend) as client:
+        resolved = await asyncio.gather(*(resolve_map(client, map) for map in maps))
+        maps = pending_maps(maps, resolved, skip_existing)
+
+        tasks = []
+
+        for _ in range(QUEUE_SIZE):
+            tasks.append(
+                asyncio.create_task(
+                    consumer(queue, client, verify, budget, refresh),
+                ),
+            )
+
+        for map in maps:
+            enqueue_tiles(queue, tmpdir, TILE_FORMAT, map, order)
+
+        await queue.join()
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    print()
+    return maps
+
+
+def submit(jobs: Path, maps: list, chunk_size: int = 8):
+    """Queue maps in a job store, in chunks, for workers to pick up."""
+    chunks = JobStore(jobs).submit(maps, chunk_size)
+    print(f"Submitted {len(maps)} maps as {chunks} chunks to {jobs}")
+
+
+async def work(
+    jobs: Path,
+    backend: str = "httpx",
+    verify: bool = False,
+    order: str = "column",
+    lease: float = 600,
+):
+    """Fetch and save chunks of maps from a job store until none are left.
+
+    Run as many workers as you like, on any machine that shares the job
+    store and maps/; each chunk is leased to one worker at a time, and
+    handed on if that worker stops renewing its lease.
+    """
+    store = JobStore(jobs)
+    worker = f"{socket.gethostname()}:{os.getpid()}"
+    tmpdir = Path("maps") / "tiles"
+    tmpdir.mkdir(parents=True, exist_ok=True)
+
+    while (claimed := store.claim(worker, lease)) is not None:
+        chunk, items = claimed
+        print(f"{worker} took chunk {chunk} of {len(items)} maps")
+        maps = [
+            {
+                **item,
+                "filename": Path(item["filename"]),
+                "infofile": Path(item["infofile"]),
+            }
+            for item in items
+        ]
+        renewing = asyncio.create_task(hold_lease(store, chunk, worker, lease))
+        try:
+            maps = await fetch_maps(maps, tmpdir, backend, verify, order)
+            for map in maps:
+                await asyncio.to_thread(save_map, map)
+        except Exception as e:
+            # Hand it back for another go, here or elsewhere.
+            print(f"Chunk {chunk} failed: {e!r}")
+            store.fail(chunk, worker, repr(e))
+            continue
+        finally:
+            renewing.cancel()
+        if not store.finish(chunk, worker, {"saved": len(maps)}):
+            # It ran out and went to another worker, who will redo it.
+            print(f"Lost the lease on chunk {chunk}, not counted as done")
+            continue
+        print(f"Chunk {chunk} done, chunks by state: {store.progress()}")
+
+
+async def main(
+    geojson: Path,
+    output_path: Path,
+    backend: str = "httpx",
+    verify: bool = False,
+    geotiff: bool = False,
+    mosaic: str | None = None,
+    order: str = "column",
+    budget: Budget | None = None,
+    jobs: Path | None = None,
+    refresh: bool = False,
+):
+    """Download IIF tiles and create a montage image.
+
+    With mosaic set to an overlap rule, every sheet is stitched into the
+    single image output_path instead of one image per sheet. Each map's
+    tiles are fetched in the given order until any budget runs out.
+    With jobs, the maps are only submitted to that job store for work().
+    With refresh, cached tiles are revalidated and only the maps that
+    changed are rebuilt.
+    """
+    mapsdir = Path("maps")
+    mapsdir.mkdir(exist_ok=True)
+    tmpdir = mapsdir / "tiles"
+    tmpdir.mkdir(exist_ok=True)
+    maps = find_maps(geojson, mapsdir, output_path.suffix)
+    if geotiff and not mosaic:
+        for map in maps:
+            map["filename"] = map["filename"].with_suffix(".tif")
+    if jobs:
+        submit(jobs, maps)
+        return
+
+    maps = await fetch_maps(
+        maps,
+        tmpdir,
+        backend,
+        verify,
+        order,
+        budget,
+        skip_existing=not (mosaic or refresh),
+        refresh=refresh,
+    )
+    if mosaic:
+        if refresh and not changed_maps(maps, output_path):
+            print(f"Skipping unchanged {output_path}")
+            return
+        save_mosaic(maps, output_path, mosaic, geotiff)
+        return
+    if refresh:
+        maps = changed_maps(maps)
+    for map in maps:
+        save_map(map)
 
 
 if __name__ == "__main__":
@@ -245,13 +495,91 @@ if __name__ == "__main__":
         default=("geojson.json"),
     )
     parser.add_argument("--output", help="Output filename")
+    parser.add_argument(
+        "--backend",
+        help="HTTP backend",
+        choices=BACKENDS,
+        default="httpx",
+    )
+    parser.add_argument(
+        "--geotiff",
+        help="Write tiled, overviewed GeoTIFFs (.tif) instead of montages",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify",
+        help="Re-check cached tiles and refetch any that are corrupt",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--mosaic",
+        help="Stitch all sheets into one image, this sheet on top where they overlap",
+        choices=RULES,
+    )
+    parser.add_argument(
+        "--order",
+        help="Order to fetch each map's tiles in",
+        choices=ORDERS,
+        default="column",
+    )
+    parser.add_argument(
+        "--seconds",
+        help="Stop fetching new tiles after this many seconds",
+        type=float,
+    )
+    parser.add_argument(
+        "--requests",
+        help="Stop fetching new tiles after this many requests",
+        type=int,
+    )
+    parser.add_argument(
+        "--refresh",
+        help="Revalidate cached tiles with conditional requests and rebuild maps",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--submit",
+        help="Queue the maps in this SQLite job store instead of fetching them",
+        type=Path,
+    )
+    parser.add_argument(
+        "--work",
+        help="Fetch and save maps from this SQLite job store until it is empty",
+        type=Path,
+    )
+    parser.add_argument(
+        "--lease",
+        help="Seconds a worker holds a chunk for between renewals",
+        type=float,
+        default=600,
+    )
     args = parser.parse_args()
     # Use provided manifest URL or default to example
     geojson = Path(args.geojson)
     if args.output:
         output_path = Path(args.output)
+    elif args.mosaic and args.geotiff:
+        output_path = Path(f"{geojson}.tif")
     else:
         output_path = Path(f"{geojson}.jpg")
-    asyncio.run(main(geojson, output_path))
+    if args.work:
+        asyncio.run(
+            work(args.work, args.backend, args.verify, args.order, args.lease),
+        )
+        sys.exit()
+    asyncio.run(
+        main(
+            geojson,
+            output_path,
+            args.backend,
+            args.verify,
+            args.geotiff,
+            args.mosaic,
+            args.order,
+            Budget(args.seconds, args.requests),
+            args.submit,
+            args.refresh,
+        ),
+    )
     total_slept_for = time.monotonic() - started_at
     print(f"{QUEUE_SIZE} workers took {total_slept_for:.2f} seconds")
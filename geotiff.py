@@ -0,0 +1,177 @@
+"""Write tiled, georeferenced GeoTIFFs straight from the tile cache."""
+
+import math
+from collections.abc import Callable
+from pathlib import Path
+
+import numpy as np
+import tifffile
+from PIL import Image
+
+from blobstore import blob_store
+from tiles import Tile
+
+# Half the circumference of the Web Mercator (EPSG:3857) world, in metres.
+MERCATOR_HALF = 20037508.342789244
+
+# GeoTIFF tags and keys, see the OGC GeoTIFF standard.
+MODEL_PIXEL_SCALE = 33550
+MODEL_TIEPOINT = 33922
+GEO_KEY_DIRECTORY = 34735
+GT_MODEL_TYPE = 1024
+GT_RASTER_TYPE = 1025
+GEOGRAPHIC_TYPE = 2048
+PROJECTED_CS_TYPE = 3072
+
+
+def bounds_transform(
+    bounds: tuple[float, float, float, float],
+    width: int,
+    height: int,
+) -> tuple[float, float, float, float]:
+    """Return (origin x, origin y, pixel width, pixel height) for bounds.
+
+    bounds are (minx, miny, maxx, maxy) covered exactly by the image.
+    """
+    minx, miny, maxx, maxy = bounds
+    return minx, maxy, (maxx - minx) / width, (maxy - miny) / height
+
+
+def xyz_transform(
+    startx: int,
+    starty: int,
+    zoom: int,
+    tile_size: int = 256,
+) -> tuple[float, float, float, float]:
+    """Return the EPSG:3857 transform for an XYZ grid starting at a tile."""
+    tile_metres = 2 * MERCATOR_HALF / 2**zoom
+    return (
+        startx * tile_metres - MERCATOR_HALF,
+        MERCATOR_HALF - starty * tile_metres,
+        tile_metres / tile_size,
+        tile_metres / tile_size,
+    )
+
+
+def geotags(transform: tuple[float, float, float, float], epsg: int) -> list:
+    """Return tifffile extratags georeferencing an image."""
+    origin_x, origin_y, pixel_width, pixel_height = transform
+    if epsg == 4326:
+        # Geographic lat/lon.
+        crs = [(GT_MODEL_TYPE, 2), (GEOGRAPHIC_TYPE, epsg)]
+    else:
+        crs = [(GT_MODEL_TYPE, 1), (PROJECTED_CS_TYPE, epsg)]
+    # Header (version 1.1.0, 3 keys), then the keys sorted by id, each
+    # (id, location 0 = inline, count 1, value). Rasters are PixelIsArea.
+    keys = [1, 1, 0, 3]
+    for key, value in sorted([*crs, (GT_RASTER_TYPE, 1)]):
+        keys.extend([key, 0, 1, value])
+    return [
+        (MODEL_PIXEL_SCALE, "d", 3, (pixel_width, pixel_height, 0.0), True),
+        (MODEL_TIEPOINT, "d", 6, (0.0, 0.0, 0.0, origin_x, origin_y, 0.0), True),
+        (GEO_KEY_DIRECTORY, "H", len(keys), keys, True),
+    ]
+
+
+def tile_pixels(tile: Tile) -> np.ndarray | None:
+    """Return a cached tile as an RGB array, without decoding blank ones."""
+    if not tile.file.exists():
+        return None
+    colour = blob_store(tile.file.parent).colour(tile.file)
+    if colour is not None:
+        width, height = tile.size
+        return np.full((height, width, 3), colour[:3], dtype=np.uint8)
+    with Image.open(tile.file) as im:
+        return np.asarray(im.convert("RGB"))
+
+
+def grid_pixels(tiles: list) -> Callable[[int, int], np.ndarray | None]:
+    """Return a pixels(x, y) callback for write_geotiff() over tiles."""
+    grid = {(tile.x, tile.y): tile for tile in tiles}
+
+    def pixels(x: int, y: int) -> np.ndarray | None:
+        tile = grid.get((x, y))
+        return None if tile is None else tile_pixels(tile)
+
+    return pixels
+
+
+def _reduce(block: np.ndarray) -> np.ndarray:
+    """Halve an RGB block by averaging 2x2 pixels, padding odd edges."""
+    height, width = block.shape[:2]
+    if height % 2 or width % 2:
+        block = np.pad(block, ((0, height % 2), (0, width % 2), (0, 0)), "edge")
+    return (
+        block.reshape(block.shape[0] // 2, 2, block.shape[1] // 2, 2, 3)
+        .mean(axis=(1, 3), dtype=np.float32)
+        .round()
+        .astype(np.uint8)
+    )
+
+
+def write_geotiff(
+    path: Path,
+    width: int,
+    height: int,
+    tile_size: tuple[int, int],
+    pixels: Callable[[int, int], np.ndarray | None],
+    transform: tuple[float, float, float, float],
+    epsg: int,
+    compression: str = "zlib",
+    min_overview: int = 256,
+):
+    """Write a tiled GeoTIFF with internal overviews, one tile at a time.
+
+    pixels(x, y) returns the RGB array for the tile at pixel (x, y), or
+    None to leave it black. Full-resolution tiles are streamed to disk as
+    they are produced and never assembled into one image; only the first
+    overview (a quarter of the pixels) is built up in memory alongside,
+    and the smaller ones are reduced from it.
+
+    tifffile writes each IFD ahead of its own tile data, so this is a
+    tiled, overviewed GeoTIFF that GDAL and tile servers read directly,
+    but not a byte-for-byte COG layout.
+    """
+    tile_width, tile_height = tile_size
+    overview = np.zeros(
+        (math.ceil(height / 2), math.ceil(width / 2), 3),
+        dtype=np.uint8,
+    )
+
+    def tiles():
+        for y in range(0, height, tile_height):
+            for x in range(0, width, tile_width):
+                block = np.zeros((tile_height, tile_width, 3), dtype=np.uint8)
+                data = pixels(x, y)
+                if data is not None:
+                    data = data[: height - y, : width - x]
+                    block[: data.shape[0], : data.shape[1]] = data
+                small = _reduce(block[: height - y, : width - x])
+                overview[
+                    y // 2 : y // 2 + small.shape[0],
+                    x // 2 : x // 2 + small.shape[1],
+                ] = small
+                yield block
+
+    options = {
+        "tile": (tile_height, tile_width),
+        "photometric": "rgb",
+        "compression": compression,
+        "metadata": None,
+    }
+    bigtiff = width * height * 3 > 2**32 - 2**28
+    with tifffile.TiffWriter(path, bigtiff=bigtiff) as tif:
+        tif.write(
+            tiles(),
+            shape=(height, width, 3),
+            dtype=np.uint8,
+            extratags=geotags(transform, epsg),
+            **options,
+        )
+        level = overview
+        while True:
+            # Reduced-resolution images follow in the main IFD chain.
+            tif.write(level, subfiletype=1, **options)
+            if max(level.shape[:2]) <= min_overview:
+                break
+            level = _reduce(level)
@@ -3,68 +3,62 @@
 
 import argparse
 import asyncio
+import math
 import sys
 import time
+from functools import partial
 from pathlib import Path
 
 import aiofiles
-import httpx
-from PIL import Image
+
+from encode import describe, save_image
+from montage import build_montage
+from schedule import ORDERS, Budget, order_grid
+from tilecache import MAX_REQUEUES, cache_tile, retryable, save_all
+from tiles import TileGrid, iiif_name, iiif_url
+from transport import BACKENDS, Transport
 
 QUEUE_SIZE = 16
 
 
-async def consumer(queue: asyncio.Queue, client: httpx.AsyncClient):
+async def consumer(
+    queue: asyncio.Queue,
+    client: Transport,
+    budget: Budget | None = None,
+):
     """Process tiles from the queue."""
     while True:
         tile = await queue.get()
-        for retry in range(2):
-            r = await client.get(tile.get("url"))
-            if r.status_code == 200:
-                if retry:
-                    sys.stderr.write("*")
-                else:
-                    sys.stderr.write("#")
-                async with aiofiles.open(tile["file"], mode="wb") as img:
-                    await img.write(r.content)
-                break   # Exit from retry loop
+        if budget and not budget.allow(tile):
+            sys.stderr.write(".")  # Out of time or requests, leave it missing
+        elif not await cache_tile(client, tile, retries=1):
+            tile.requeues += 1
+            if tile.requeues <= MAX_REQUEUES and retryable(tile.error):
+                # Try it again once the rest of the queue has had a go.
+                queue.put_nowait(tile)
             else:
                 sys.stderr.write("!")
-                await asyncio.sleep(5)
 
         sys.stderr.flush()
         queue.task_done()
 
 
-def tile_url(
-    base_url: str,
-    scale: int,
+async def main(
+    imageurl: str,
+    output_path: str,
     img_type: str,
-    x: int,
-    y: int,
-    width: int,
-    height: int,
-) -> str:
-    """Generate the URL for a tile image."""
-    return (
-        f"{base_url}/"
-        f"{x},{y},{width},{height}/"
-        f"{width},{height}/{scale}/default.{img_type}"
-    )
-
-
-def tile_filename(path: str, img_type: str, x: int, y: int) -> str:
-    """Generate the filename for a tile image."""
-    return f"{path}_{x}_{y}.{img_type}"
+    backend: str = "httpx",
+    order: str = "column",
+    budget: Budget | None = None,
+):
+    """Download IIF tiles and create a montage image.
 
-
-async def main(imageurl: str, output_path: str, img_type: str):
-    """Download IIF tiles and create a montage image."""
+    Tiles are fetched in the given order until any budget runs out."""
     queue = asyncio.Queue()
 
     print(f"Downloading tiles for {imageurl}:")
     async with aiofiles.tempfile.TemporaryDirectory() as tmpdir:
-        async with httpx.AsyncClient(http2=True) as client:
+        async with Transport(backend) as client:
             r = await client.get(imageurl)
             if r.status_code != 200:
                 print(f"Error fetching image info: {r.status_code}")
@@ -79,31 +73,23 @@ async def main(imageurl: str, output_path: str, img_type: str):
             scale_factor: int = min(image_data["tiles"][0]["scaleFactors"])
             # And pass the index of scale, as per the API.
             scale: int = image_data["tiles"][0]["scaleFactors"].index(scale_factor)
-            tiles = []
+            grid = TileGrid(
+                Path(tmpdir),
+                (image_data["width"], image_data["height"]),
+                (tile_width, tile_height),
+                partial(iiif_name, path, img_type),
+                partial(iiif_url, base_url, scale, img_type),
+            )
             tasks = []
 
             for _ in range(QUEUE_SIZE):
-                tasks.append(asyncio.create_task(consumer(queue, client)))
-
-            for x in range(0, image_data["width"], tile_width):
-                for y in range(0, image_data["height"], tile_height):
-                    tile = {"x": x, "y": y}
-                    # The right-most and bottom-most tiles need to be decreased
-                    # if they would exceed the size of the full image.
-                    this_tile_width = min(tile_width, image_data["width"] - x)
-                    this_tile_height = min(tile_height, image_data["height"] - y)
-                    tile["file"] = Path(tmpdir, tile_filename(path, img_type, x, y))
-                    tile["url"] = tile_url(
-                        base_url,
-                        scale,
-                        img_type,
-                        x,
-                        y,
-                        this_tile_width,
-                        this_tile_height,
-                    )
-                    tiles.append(tile)
-                    queue.put_nowait(tile)
+                tasks.append(asyncio.create_task(consumer(queue, client, budget)))
+
+            columns = math.ceil(image_data["width"] / tile_width)
+            rows = math.ceil(image_data["height"] / tile_height)
+            tiles = grid.tiles(order_grid(columns, rows, order))
+            for tile in tiles:
+                queue.put_nowait(tile)
 
             await queue.join()
 
@@ -114,12 +100,11 @@ async def main(imageurl: str, output_path: str, img_type: str):
 
         print()
         print(f"Creating montage {output_path}")
-        montage = Image.new("RGB", (image_data["width"], image_data["height"]))
-        for tile in tiles:
-            with Image.open(tile["file"]) as im:
-                montage.paste(im, (tile["x"], tile["y"]))
-        montage.save(output_path)
-        print(f"Montage saved to {output_path}")
+        montage = build_montage(image_data["width"], image_data["height"], tiles)
+        report = save_image(montage, output_path)
+        print(f"Montage saved to {output_path}: {describe(report)}")
+        # Flush the tile indexes while their temporary directory still exists.
+        save_all()
 
 
 if __name__ == "__main__":
@@ -135,6 +120,28 @@ if __name__ == "__main__":
         ),
     )
     parser.add_argument("--output", help="Output filename")
+    parser.add_argument(
+        "--backend",
+        help="HTTP backend",
+        choices=BACKENDS,
+        default="httpx",
+    )
+    parser.add_argument(
+        "--order",
+        help="Order to fetch tiles in",
+        choices=ORDERS,
+        default="column",
+    )
+    parser.add_argument(
+        "--seconds",
+        help="Stop fetching new tiles after this many seconds",
+        type=float,
+    )
+    parser.add_argument(
+        "--requests",
+        help="Stop fetching new tiles after this many requests",
+        type=int,
+    )
     args = parser.parse_args()
     # Use provided manifest URL or default to example
     imageurl = args.url
@@ -145,6 +152,15 @@ if __name__ == "__main__":
         img_type = output_path.split(".")[-1]
     else:
         output_path = f"{path}.{img_type}"
-    asyncio.run(main(imageurl, output_path, img_type))
+    asyncio.run(
+        main(
+            imageurl,
+            output_path,
+            img_type,
+            args.backend,
+            args.order,
+            Budget(args.seconds, args.requests),
+        ),
+    )
     total_slept_for = time.monotonic() - started_at
     print(f"{QUEUE_SIZE} workers took {total_slept_for:.2f} seconds")
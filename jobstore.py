@@ -0,0 +1,147 @@
+"""Hand out chunks of a job list to workers on many machines, via SQLite.
+
+The database lives on disk shared by every node. Each worker claims a
+chunk by leasing it for a while, renewing the lease as it goes; if a
+worker dies the lease runs out and the chunk goes to someone else. Use a
+rollback journal (SQLite's default), not WAL, on network filesystems.
+"""
+
+import asyncio
+import json
+import sqlite3
+import time
+from contextlib import closing
+from pathlib import Path
+
+# A chunk that has failed this many times is left for someone to look at.
+MAX_ATTEMPTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id INTEGER PRIMARY KEY,
+    items TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    lease_until REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    result TEXT
+)
+"""
+
+
+class JobStore:
+    """A list of chunks, each pending, leased, done or failed.
+
+    Every call opens its own connection, so a store can be shared between
+    threads, and takes SQLite's write lock for as long as it needs it.
+    Leases are wall-clock times, so nodes' clocks should roughly agree.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        with closing(self._connect()) as db:
+            db.execute(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit, with explicit BEGIN IMMEDIATE where it matters.
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    def submit(self, items: list, chunk_size: int = 8) -> int:
+        """Add items as chunks of up to chunk_size, returning how many."""
+        chunks = [
+            json.dumps(items[start : start + chunk_size], default=str)
+            for start in range(0, len(items), chunk_size)
+        ]
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.executemany(
+                "INSERT INTO chunks (items) VALUES (?)",
+                [(chunk,) for chunk in chunks],
+            )
+            db.execute("COMMIT")
+        return len(chunks)
+
+    def claim(self, worker: str, lease: float) -> tuple[int, list] | None:
+        """Lease the next pending or expired chunk, or None if there isn't one.
+
+        An expired chunk that has already had MAX_ATTEMPTS is marked failed
+        instead, as its workers keep dying on it.
+        """
+        now = time.time()
+        with closing(self._connect()) as db:
+            db.execute("BEGIN IMMEDIATE")
+            db.execute(
+                "UPDATE chunks SET state = 'failed', result = ?, lease_until = NULL"
+                " WHERE state = 'leased' AND lease_until < ? AND attempts >= ?",
+                (json.dumps("lease expired"), now, MAX_ATTEMPTS),
+            )
+            row = db.execute(
+                "SELECT id, items FROM chunks"
+                " WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?)"
+                " ORDER BY id LIMIT 1",
+                (now,),
+            ).fetchone()
+            if row is not None:
+                db.execute(
+                    "UPDATE chunks SET state = 'leased', worker = ?,"
+                    " lease_until = ?, attempts = attempts + 1 WHERE id = ?",
+                    (worker, now + lease, row[0]),
+                )
+            db.execute("COMMIT")
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def _update(self, sql: str, chunk: int, worker: str, *params) -> bool:
+        """Run an update on a chunk only while worker holds its lease."""
+        with closing(self._connect()) as db:
+            cursor = db.execute(
+                f"{sql} WHERE id = ? AND worker = ? AND state = 'leased'",
+                (*params, chunk, worker),
+            )
+            return cursor.rowcount == 1
+
+    def renew(self, chunk: int, worker: str, lease: float) -> bool:
+        """Extend a lease, returning False if it has gone to someone else."""
+        return self._update(
+            "UPDATE chunks SET lease_until = ?",
+            chunk,
+            worker,
+            time.time() + lease,
+        )
+
+    def finish(self, chunk: int, worker: str, result=None) -> bool:
+        """Mark a chunk done, with a JSON-able result."""
+        return self._update(
+            "UPDATE chunks SET state = 'done', result = ?",
+            chunk,
+            worker,
+            json.dumps(result),
+        )
+
+    def fail(self, chunk: int, worker: str, error: str) -> bool:
+        """Give a chunk back, or mark it failed once it has had MAX_ATTEMPTS."""
+        return self._update(
+            "UPDATE chunks SET result = ?, lease_until = NULL,"
+            " state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END",
+            chunk,
+            worker,
+            json.dumps(error),
+            MAX_ATTEMPTS,
+        )
+
+    def progress(self) -> dict:
+        """Count the chunks in each state."""
+        with closing(self._connect()) as db:
+            return dict(
+                db.execute("SELECT state, COUNT(*) FROM chunks GROUP BY state"),
+            )
+
+
+async def hold_lease(store: JobStore, chunk: int, worker: str, lease: float):
+    """Keep renewing a chunk's lease until cancelled or it is lost."""
+    while True:
+        await asyncio.sleep(lease / 3)
+        if not await asyncio.to_thread(store.renew, chunk, worker, lease):
+            print(f"Lost the lease on chunk {chunk}")
+            return
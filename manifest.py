@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""IIIF Presentation manifest downloader."""
+
+import argparse
+import asyncio
+import json
+import math
+import sys
+import time
+from functools import partial
+from pathlib import Path
+
+import httpx
+
+from encode import describe, save_image
+from montage import build_montage
+from schedule import ORDERS, Budget, order_grid
+from tilecache import MAX_REQUEUES, cache_tile, retryable
+from tiles import Tile, TileGrid, iiif_name, iiif_url
+from transport import BACKENDS, Transport
+
+QUEUE_SIZE = 32
+# Canvases being assembled at once; each holds a full-size image in memory.
+MONTAGE_WORKERS = 2
+
+
+def canvas_label(canvas: dict) -> str:
+    """Return a canvas's label as plain text."""
+    label = canvas.get("label", "")
+    if isinstance(label, dict):
+        # Presentation 3 language map, e.g. {"@none": ["..."]}
+        label = next(iter(label.values()), [""])
+    if isinstance(label, list):
+        label = label[0] if label else ""
+    return str(label)
+
+
+def _services(resource: dict) -> list:
+    services = resource.get("service", [])
+    if isinstance(services, dict):
+        services = [services]
+    return services
+
+
+def _is_image_service(service: dict) -> bool:
+    kind = service.get("type", service.get("@type", ""))
+    context = f"{service.get('@context', '')} {service.get('profile', '')}"
+    return "ImageService" in kind or "iiif.io/api/image" in context
+
+
+def image_services(manifest: dict) -> list:
+    """List every canvas in a manifest with the image service painting it.
+
+    Reads Presentation 3 (items/AnnotationPage/Annotation) and
+    Presentation 2 (sequences/canvases/images) manifests.
+    """
+    canvases = []
+    if "items" in manifest:
+        bodies = (
+            (canvas, annotation.get("body", {}))
+            for canvas in manifest["items"]
+            for page in canvas.get("items", [])
+            for annotation in page.get("items", [])
+        )
+    else:
+        bodies = (
+            (canvas, image.get("resource", {}))
+            for sequence in manifest.get("sequences", [])
+            for canvas in sequence.get("canvases", [])
+            for image in canvas.get("images", [])
+        )
+    for canvas, body in bodies:
+        for service in _services(body):
+            if not _is_image_service(service):
+                continue
+            canvases.append(
+                {
+                    "index": len(canvases),
+                    "label": canvas_label(canvas),
+                    "service": service.get("id", service.get("@id")).rstrip("/"),
+                },
+            )
+            break
+    return canvases
+
+
+async def resolve_info(client: Transport, canvas: dict) -> bool:
+    """Fetch the info.json for a canvas's image service.
+
+    Failures are reported and skipped, rather than losing the whole manifest.
+    """
+    try:
+        r = await client.get(f"{canvas['service']}/info.json")
+        if r.status_code != 200:
+            print(f"Error fetching image info for {canvas['service']}: {r.status_code}")
+            return False
+        canvas["image_data"] = r.json()
+    except (httpx.TransportError, ValueError) as e:
+        print(f"Error fetching image info for {canvas['service']}: {e!r}")
+        return False
+    return True
+
+
+def enqueue_tiles(
+    queue: asyncio.Queue,
+    tmpdir: Path,
+    img_type: str,
+    canvas: dict,
+    order: str = "column",
+):
+    """Queue every tile of a canvas, recording them for its montage."""
+    image_data = canvas["image_data"]
+    base_url = image_data.get("id", image_data.get("@id")).rstrip("/")
+    path = base_url.split("/")[-1]
+    tile_width: int = image_data["tiles"][0]["width"]
+    tile_height: int = image_data["tiles"][0].get("height", tile_width)
+    profile = image_data.get("profile", "")
+    level0 = "level0" in str(profile)
+    canvas["width"] = image_data["width"]
+    canvas["height"] = image_data["height"]
+    grid = TileGrid(
+        tmpdir,
+        (canvas["width"], canvas["height"]),
+        (tile_width, tile_height),
+        partial(iiif_name, path, img_type),
+        partial(iiif_url, base_url, 0, img_type, level0=level0),
+    )
+
+    columns = math.ceil(image_data["width"] / tile_width)
+    rows = math.ceil(image_data["height"] / tile_height)
+    canvas["tiles"] = grid.tiles(order_grid(columns, rows, order))
+    for tile in canvas["tiles"]:
+        tile.canvas = canvas
+    canvas["remaining"] = len(canvas["tiles"])
+    for tile in canvas["tiles"]:
+        queue.put_nowait(tile)
+
+
+def save_canvas(canvas: dict):
+    """Assemble and save one canvas's output image."""
+    print(f"\nCreating montage {canvas['filename']} ({canvas['label']})")
+    montage = build_montage(canvas["width"], canvas["height"], canvas["tiles"])
+    report = save_image(montage, canvas["filename"])
+    print(f"Montage saved to {canvas['filename']}: {describe(report)}")
+
+
+class Pipeline:
+    """Download the tiles of many canvases through one pool of workers.
+
+    Each canvas is assembled in a thread as soon as its last tile is in,
+    while the workers carry on with the tiles of the other canvases.
+    """
+
+    def __init__(
+        self,
+        client: Transport,
+        verify: bool = False,
+        budget: Budget | None = None,
+        refresh: bool = False,
+    ):
+        self.client = client
+        self.verify = verify
+        self.budget = budget
+        self.refresh = refresh
+        self.queue = asyncio.Queue()
+        self.montages = []
+        self._montage_slots = asyncio.Semaphore(MONTAGE_WORKERS)
+
+    async def _save(self, canvas: dict):
+        async with self._montage_slots:
+            await asyncio.to_thread(save_canvas, canvas)
+
+    def _finished(self, tile: Tile):
+        canvas = tile.canvas
+        canvas["remaining"] -= 1
+        if not canvas["remaining"]:
+            self.montages.append(asyncio.create_task(self._save(canvas)))
+
+    async def consumer(self):
+        """Process tiles from the queue."""
+        while True:
+            tile = await self.queue.get()
+            if self.budget and not self.budget.allow(tile):
+                sys.stderr.write(".")  # Out of time or requests, leave it missing
+                self._finished(tile)
+            elif await cache_tile(
+                self.client,
+                tile,
+                retries=1,
+                verify=self.verify,
+                refresh=self.refresh,
+            ):
+                self._finished(tile)
+            else:
+                tile.requeues += 1
+                if tile.requeues <= MAX_REQUEUES and retryable(tile.error):
+                    # Try it again once the rest of the queue has had a go.
+                    self.queue.put_nowait(tile)
+                else:
+                    sys.stderr.write("!")
+                    self._finished(tile)
+
+            sys.stderr.flush()
+            self.queue.task_done()
+
+    async def run(self):
+        """Work through the queue, then wait for the montages."""
+        tasks = []
+
+        for _ in range(QUEUE_SIZE):
+            tasks.append(asyncio.create_task(self.consumer()))
+
+        await self.queue.join()
+
+        for task in tasks:
+            task.cancel()
+
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await asyncio.gather(*self.montages)
+
+
+async def load_manifest(client: Transport, source: str) -> dict:
+    """Read a manifest from a URL or a local file."""
+    if source.startswith(("http://", "https://")):
+        r = await client.get(source)
+        r.raise_for_status()
+        return r.json()
+    return json.loads(Path(source).read_text())
+
+
+async def main(
+    source: str,
+    output_dir: Path,
+    img_type: str,
+    backend: str = "httpx",
+    verify: bool = False,
+    order: str = "column",
+    budget: Budget | None = None,
+    refresh: bool = False,
+):
+    """Download every canvas in a IIIF manifest.
+
+    Each canvas's tiles are fetched in the given order until any budget
+    runs out. With refresh, existing canvases are rebuilt from revalidated
+    tiles."""
+    mapsdir = Path("maps")
+    mapsdir.mkdir(exist_ok=True)
+    tmpdir = mapsdir / "tiles"
+    tmpdir.mkdir(exist_ok=True)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    async with Transport(backend) as client:
+        manifest = await load_manifest(client, source)
+        canvases = image_services(manifest)
+        print(f"Found {len(canvases)} canvases in {source}")
+        stem = Path(source.rstrip("/")).stem
+        for canvas in canvases:
+            canvas["filename"] = output_dir / f"{stem}_{canvas['index']:03d}.{img_type}"
+
+        resolved = await asyncio.gather(
+            *(resolve_info(client, canvas) for canvas in canvases),
+        )
+        pipeline = Pipeline(client, verify, budget, refresh)
+        for canvas, ok in zip(canvases, resolved, strict=True):
+            if not ok:
+                continue
+            if not refresh and canvas["filename"].exists():
+                print(f"Skipping existing {canvas['filename']}")
+                continue
+            enqueue_tiles(pipeline.queue, tmpdir, img_type, canvas, order)
+
+        await pipeline.run()
+
+
+if __name__ == "__main__":
+    started_at = time.monotonic()
+    parser = argparse.ArgumentParser(prog="manifest", usage="%(prog)s [options]")
+    parser.add_argument(
+        "--url",
+        help="IIIF Presentation manifest URL or file.",
+        default="index.json",
+    )
+    parser.add_argument(
+        "--output-dir",
+        help="Directory for the canvas images",
+        default="maps",
+    )
+    parser.add_argument("--format", help="Image format", default="jpg")
+    parser.add_argument(
+        "--backend",
+        help="HTTP backend",
+        choices=BACKENDS,
+        default="httpx",
+    )
+    parser.add_argument(
+        "--verify",
+        help="Re-check cached tiles and refetch any that are corrupt",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--order",
+        help="Order to fetch tiles in",
+        choices=ORDERS,
+        default="column",
+    )
+    parser.add_argument(
+        "--seconds",
+        help="Stop fetching new tiles after this many seconds",
+        type=float,
+    )
+    parser.add_argument(
+        "--requests",
+        help="Stop fetching new tiles after this many requests",
+        type=int,
+    )
+    parser.add_argument(
+        "--refresh",
+        help="Revalidate cached tiles with the server, refetching changed ones",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    asyncio.run(
+        main(
+            args.url,
+            Path(args.output_dir),
+            args.format,
+            args.backend,
+            args.verify,
+            args.order,
+            Budget(args.seconds, args.requests),
+            args.refresh,
+        ),
+    )
+    total_slept_for = time.monotonic() - started_at
+    print(f"{QUEUE_SIZE} workers took {total_slept_for:.2f} seconds")
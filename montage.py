@@ -0,0 +1,38 @@
+"""Assemble cached tiles into a single image."""
+
+from PIL import Image
+
+from blobstore import blob_store
+from tiles import Tile
+
+
+def paste_tile(montage: Image.Image, tile: Tile) -> str:
+    """Paste one tile, returning "blank", "tile" or "missing"."""
+    if not tile.file.exists():
+        print(f"Missing {tile.file}: {tile.error}")
+        return "missing"
+    colour = blob_store(tile.file.parent).colour(tile.file)
+    if colour is not None:
+        # Known blank tile: fill its box rather than decoding it.
+        width, height = tile.size
+        montage.paste(
+            colour[:3],
+            (tile.x, tile.y, tile.x + width, tile.y + height),
+        )
+        return "blank"
+    with Image.open(tile.file) as im:
+        montage.paste(im, (tile.x, tile.y))
+    return "tile"
+
+
+def build_montage(width: int, height: int, tiles: list) -> Image.Image:
+    """Paste every tile into a new RGB image of the given size."""
+    montage = Image.new("RGB", (width, height))
+    counts = {"tile": 0, "blank": 0, "missing": 0}
+    for tile in tiles:
+        counts[paste_tile(montage, tile)] += 1
+    print(
+        f"Pasted {counts['tile']} tiles, filled {counts['blank']} blank, "
+        f"{counts['missing']} missing",
+    )
+    return montage
@@ -0,0 +1,170 @@
+"""Stitch tiles from several georeferenced sheets into one image."""
+
+import math
+import re
+from collections import defaultdict
+from collections.abc import Callable
+
+import numpy as np
+from PIL import Image
+
+from blobstore import blob_store
+from tiles import Tile
+
+# Which sheet ends up on top where sheets overlap.
+RULES = ("newest", "oldest", "first")
+
+
+def sheet_year(title: str) -> int:
+    """Return the publication (or survey) year from an NLS sheet title."""
+    for label in ("Published", "Revised", "Surveyed"):
+        match = re.search(rf"{label}:\s*(\d{{4}})", title)
+        if match:
+            return int(match.group(1))
+    match = re.search(r"\b(1[5-9]\d\d|20\d\d)\b", title)
+    return int(match.group(1)) if match else 0
+
+
+def paint_order(sheets: list, rule: str) -> list:
+    """Order sheets bottom first, so the one the rule prefers is painted last."""
+    if rule == "newest":
+        return sorted(sheets, key=lambda sheet: sheet["year"])
+    if rule == "oldest":
+        return sorted(sheets, key=lambda sheet: sheet["year"], reverse=True)
+    if rule == "first":
+        return list(reversed(sheets))
+    raise ValueError(f"Unknown overlap rule {rule!r}, expected {RULES}")
+
+
+def mosaic_grid(bounds: tuple, sheets: list) -> tuple[int, int, float, float]:
+    """Size the mosaic of bounds at the finest resolution of any sheet.
+
+    Returns (width, height, pixel width, pixel height).
+    """
+    if not sheets:
+        raise ValueError("no sheets")
+    minx, miny, maxx, maxy = bounds
+    pixel_width = min(
+        (sheet["bounds"][2] - sheet["bounds"][0]) / sheet["width"] for sheet in sheets
+    )
+    pixel_height = min(
+        (sheet["bounds"][3] - sheet["bounds"][1]) / sheet["height"] for sheet in sheets
+    )
+    return (
+        math.ceil((maxx - minx) / pixel_width),
+        math.ceil((maxy - miny) / pixel_height),
+        pixel_width,
+        pixel_height,
+    )
+
+
+def _tile_image(tile: Tile, box: tuple[int, int, int, int]) -> Image.Image | tuple:
+    """Return a cached tile resampled to box, or its colour if it is blank."""
+    colour = blob_store(tile.file.parent).colour(tile.file)
+    if colour is not None:
+        return colour[:3]
+    width, height = box[2] - box[0], box[3] - box[1]
+    with Image.open(tile.file) as im:
+        im = im.convert("RGB")
+    if im.size != (width, height):
+        im = im.resize((width, height), Image.Resampling.BILINEAR)
+    return im
+
+
+def place_tiles(bounds: tuple, sheets: list, rule: str = "newest") -> list:
+    """Return (tile, box) for each cached tile on the mosaic, bottom first.
+
+    Each sheet's scan is assumed to span its bounds exactly; boxes are in
+    mosaic pixels, and tiles outside bounds are left out.
+    """
+    minx, miny, maxx, maxy = bounds
+    width, height, pixel_width, pixel_height = mosaic_grid(bounds, sheets)
+    placed = []
+    for sheet in paint_order(sheets, rule):
+        sheet_minx, _, _, sheet_maxy = sheet["bounds"]
+        # Sheet pixels to mosaic pixels.
+        scale_x = (sheet["bounds"][2] - sheet_minx) / sheet["width"] / pixel_width
+        scale_y = (sheet_maxy - sheet["bounds"][1]) / sheet["height"] / pixel_height
+        offset_x = (sheet_minx - minx) / pixel_width
+        offset_y = (maxy - sheet_maxy) / pixel_height
+        for tile in sheet["tiles"]:
+            tile_width, tile_height = tile.size
+            box = (
+                round(offset_x + tile.x * scale_x),
+                round(offset_y + tile.y * scale_y),
+                round(offset_x + (tile.x + tile_width) * scale_x),
+                round(offset_y + (tile.y + tile_height) * scale_y),
+            )
+            if box[2] <= 0 or box[3] <= 0 or box[0] >= width or box[1] >= height:
+                continue
+            if box[0] < box[2] and box[1] < box[3] and tile.file.exists():
+                placed.append((tile, box))
+    return placed
+
+
+def mosaic_pixels(
+    bounds: tuple,
+    sheets: list,
+    rule: str = "newest",
+    tile_size: tuple[int, int] = (256, 256),
+) -> Callable[[int, int], np.ndarray | None]:
+    """Return a pixels(x, y) callback painting one output tile at a time.
+
+    Each output tile is painted from the sheet tiles over it, bottom
+    first. A sheet tile is decoded once and kept only until the last
+    output tile it covers has been painted, so the whole mosaic is never
+    held in memory when output tiles are asked for row by row, as
+    write_geotiff() does.
+    """
+    width, height, *_ = mosaic_grid(bounds, sheets)
+    out_width, out_height = tile_size
+    placed = place_tiles(bounds, sheets, rule)
+    # Output tile (x, y) to the placed tiles over it, bottom first.
+    covers = defaultdict(list)
+    uses = [0] * len(placed)
+    for index, (_, box) in enumerate(placed):
+        top, bottom = max(box[1], 0), min(box[3], height)
+        left, right = max(box[0], 0), min(box[2], width)
+        for y in range(top // out_height * out_height, bottom, out_height):
+            for x in range(left // out_width * out_width, right, out_width):
+                covers[(x, y)].append(index)
+                uses[index] += 1
+    decoded = {}
+
+    def pixels(x: int, y: int) -> np.ndarray | None:
+        indices = covers.pop((x, y), None)
+        if not indices:
+            return None
+        canvas = Image.new("RGB", tile_size)
+        for index in indices:
+            tile, box = placed[index]
+            if index not in decoded:
+                decoded[index] = _tile_image(tile, box)
+            image = decoded[index]
+            if isinstance(image, tuple):
+                canvas.paste(image, (box[0] - x, box[1] - y, box[2] - x, box[3] - y))
+            else:
+                canvas.paste(image, (box[0] - x, box[1] - y))
+            uses[index] -= 1
+            if not uses[index]:
+                del decoded[index]
+        return np.asarray(canvas)
+
+    return pixels
+
+
+def build_mosaic(bounds: tuple, sheets: list, rule: str = "newest") -> Image.Image:
+    """Place every sheet's cached tiles into one image covering bounds.
+
+    For formats that need the whole image at once; see mosaic_pixels()
+    for writing a GeoTIFF without it.
+    """
+    width, height, *_ = mosaic_grid(bounds, sheets)
+    pixels = mosaic_pixels(bounds, sheets, rule)
+    mosaic = Image.new("RGB", (width, height))
+    for y in range(0, height, 256):
+        for x in range(0, width, 256):
+            data = pixels(x, y)
+            if data is not None:
+                mosaic.paste(Image.fromarray(data), (x, y))
+    return mosaic
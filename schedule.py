@@ -0,0 +1,111 @@
+"""Choose the order tiles are fetched in, and when to stop fetching."""
+
+import math
+import time
+
+from tiles import Tile
+
+# column: the old column-major order, a strip at a time.
+# centre: nearest the middle of the image first.
+# hilbert: along a Hilbert curve, so neighbouring tiles are fetched together.
+# coarse: an even spread over the whole image first, then filled in.
+ORDERS = ("column", "centre", "hilbert", "coarse")
+
+# The error recorded on tiles skipped once the budget has run out.
+OVER_BUDGET = "over budget"
+
+# coarse order starts with every 2**COARSE_LEVELS th tile each way.
+COARSE_LEVELS = 3
+
+
+def hilbert_index(side: int, col: int, row: int) -> int:
+    """Return the distance of (col, row) along a Hilbert curve.
+
+    side is the width of the square the curve fills, a power of two.
+    """
+    index = 0
+    step = side // 2
+    while step:
+        right = 1 if col & step else 0
+        down = 1 if row & step else 0
+        index += step * step * ((3 * right) ^ down)
+        # Rotate the quadrant so the curve joins up.
+        if not down:
+            if right:
+                col = side - 1 - col
+                row = side - 1 - row
+            col, row = row, col
+        step //= 2
+    return index
+
+
+def _coarse_level(col: int, row: int) -> int:
+    """Return how coarse a grid (col, row) lies on, up to COARSE_LEVELS."""
+    level = 0
+    while level < COARSE_LEVELS and not (col | row) & (1 << level):
+        level += 1
+    return level
+
+
+def order_grid(columns: int, rows: int, order: str = "column") -> list:
+    """Return every (col, row) of a grid in the order they should be fetched."""
+    cells = [(col, row) for col in range(columns) for row in range(rows)]
+    if order == "column":
+        return cells
+    side = 1 << max(columns - 1, rows - 1, 1).bit_length()
+    if order == "hilbert":
+        return sorted(cells, key=lambda cell: hilbert_index(side, *cell))
+    if order == "centre":
+        middle_col, middle_row = (columns - 1) / 2, (rows - 1) / 2
+        return sorted(
+            cells,
+            key=lambda cell: math.hypot(cell[0] - middle_col, cell[1] - middle_row),
+        )
+    if order == "coarse":
+        return sorted(
+            cells,
+            key=lambda cell: (-_coarse_level(*cell), hilbert_index(side, *cell)),
+        )
+    raise ValueError(f"Unknown tile order {order!r}, expected {ORDERS}")
+
+
+class Budget:
+    """Stop fetching tiles after a wall-clock time or number of requests.
+
+    Tiles already in the cache cost nothing and are always allowed, so
+    a job run again with the same budget picks up where it left off.
+    """
+
+    def __init__(self, seconds: float | None = None, requests: int | None = None):
+        self.deadline = None if seconds is None else time.monotonic() + seconds
+        self.limit = requests
+        self.requests = 0
+
+    def exhausted(self) -> bool:
+        """Return True once the time or requests have run out."""
+        if self.limit is not None and self.requests >= self.limit:
+            return True
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def allow(self, tile: Tile) -> bool:
+        """Return whether to fetch a tile, counting it against the budget."""
+        if tile.file.exists():
+            return True
+        if self.exhausted():
+            tile.error = OVER_BUDGET
+            return False
+        self.requests += 1
+        return True
+
+    def share(self, shares: int, index: int = 0) -> "Budget":
+        """Return share index of what is left, e.g. for a worker process.
+
+        The first shares get one more request each if it doesn't divide
+        evenly, so together they never allow more than is left.
+        """
+        budget = Budget()
+        budget.deadline = self.deadline
+        if self.limit is not None:
+            share, extra = divmod(max(self.limit - self.requests, 0), shares)
+            budget.limit = share + (index < extra)
+        return budget
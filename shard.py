@@ -0,0 +1,73 @@
+"""Spread a download across worker processes, each with its own event loop."""
+
+import asyncio
+import multiprocessing
+import queue
+from collections.abc import Callable
+
+
+def split(cells: list, shards: int) -> list[list]:
+    """Cut cells into contiguous runs, one per shard.
+
+    Cut from a Hilbert ordered grid, each shard is a compact patch.
+    """
+    return [
+        cells[len(cells) * index // shards : len(cells) * (index + 1) // shards]
+        for index in range(shards)
+    ]
+
+
+def work(fn: Callable, index: int, job, messages: multiprocessing.Queue):
+    """Run fn(job, report) in a worker process and send back its result.
+
+    report(kind, value) passes a message to the coordinator. The result
+    is None if fn raised.
+    """
+    result = None
+    try:
+        result = fn(job, lambda kind, value: messages.put((index, kind, value)))
+    finally:
+        messages.put((index, "done", result))
+
+
+async def run_shards(
+    fn: Callable,
+    jobs: list,
+    on_message: Callable[[int, str, object], None],
+) -> list:
+    """Run fn(job, report) for each job in its own process.
+
+    Messages from the workers go to on_message(index, kind, value) as they
+    arrive. Returns each job's result, or None where its worker failed.
+    """
+    # Spawn rather than fork, as this process already has an event loop.
+    context = multiprocessing.get_context("spawn")
+    messages = context.Queue()
+    processes = [
+        context.Process(target=work, args=(fn, index, job, messages))
+        for index, job in enumerate(jobs)
+    ]
+    for process in processes:
+        process.start()
+
+    results = [None] * len(jobs)
+    running = set(range(len(jobs)))
+    while running:
+        try:
+            index, kind, value = await asyncio.to_thread(messages.get, timeout=1)
+        except queue.Empty:
+            # A worker that was killed never says it is done.
+            for index in list(running):
+                if processes[index].exitcode not in (None, 0):
+                    print(f"Shard {index} died: exit code {processes[index].exitcode}")
+                    running.discard(index)
+            continue
+        if kind == "done":
+            results[index] = value
+            running.discard(index)
+        else:
+            on_message(index, kind, value)
+
+    for process in processes:
+        await asyncio.to_thread(process.join)
+    return results
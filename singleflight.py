@@ -0,0 +1,34 @@
+"""Request coalescing for concurrent tile downloads."""
+
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+
+
+class SingleFlight:
+    """Run at most one in-flight call per key.
+
+    Concurrent callers asking for the same key (a tile URL or cache file)
+    await the first caller's result instead of starting their own download.
+    The key is forgotten as soon as the call finishes, so a later caller
+    (e.g. after a failed download) starts a fresh attempt.
+    """
+
+    def __init__(self):
+        self._flights: dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def do[T](self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Return the result of fn(), sharing it with concurrent callers."""
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(fn())
+            self._flights[key] = flight
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+        # Shield so one cancelled waiter does not abort the shared download.
+        return await asyncio.shield(flight)
+
+
+# Shared by every downloader running in this process.
+FLIGHTS = SingleFlight()
@@ -0,0 +1,350 @@
+"""Stream tile bodies into the on-disk tile cache."""
+
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from pathlib import Path
+
+import httpx
+
+from blobstore import BlobStore, blob_store, save_all as save_indexes
+from singleflight import FLIGHTS
+from tiles import Tile
+from transport import Transport
+from validators import Validators, save_all as save_validators, validators
+
+# Most tiles are 10-30 KB. Pooled buffers are this size; a tile whose
+# Content-Length says it is bigger gets a buffer of its own.
+BUFFER_SIZE = 32 * 1024
+# Buffers kept for reuse; beyond this, returned buffers are dropped.
+MAX_FREE_BUFFERS = 256
+# Flush a batch early once it holds this many bytes.
+BATCH_BYTES = 4 * 1024 * 1024
+# Times a failed tile goes back on the queue before it is given up on.
+MAX_REQUEUES = 2
+# Client errors worth asking again for; any other 4xx is final.
+RETRY_STATUSES = {408, 429}
+# Seconds to gather changes before saving blob indexes and validators.
+SAVE_INTERVAL = 30.0
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+# Start-of-frame markers carry the image dimensions; C4, C8 and CC don't.
+JPEG_SOF = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+# The IEND chunk type and its fixed CRC end every complete PNG.
+PNG_IEND = b"IEND\xaeB`\x82"
+
+
+def _jpeg_size(body: memoryview) -> tuple[int, int] | None:
+    """Find a JPEG's (width, height) by walking its marker segments."""
+    i = 2
+    while i + 9 <= len(body):
+        if body[i] != 0xFF:
+            return None
+        marker = body[i + 1]
+        if marker == 0xFF:  # Fill byte
+            i += 1
+        elif marker in JPEG_SOF:
+            height = int.from_bytes(body[i + 5 : i + 7])
+            width = int.from_bytes(body[i + 7 : i + 9])
+            return width, height
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD8:  # No length field
+            i += 2
+        else:
+            i += 2 + int.from_bytes(body[i + 2 : i + 4])
+    return None
+
+
+def check_tile(
+    body: bytes | memoryview,
+    length: int | None = None,
+    size: tuple[int, int] | None = None,
+) -> str | None:
+    """Return why a tile body is unusable, or None if it looks complete.
+
+    This only looks at the JPEG/PNG framing, the expected Content-Length
+    and the dimensions in the header, so it is far cheaper than decoding.
+    """
+    body = memoryview(body)
+    if not body:
+        return "empty"
+    if length is not None and len(body) != length:
+        return f"got {len(body)} of {length} bytes"
+    if body[:2] == JPEG_SOI:
+        # Some encoders pad after the EOI marker.
+        if not bytes(body[-16:]).rstrip(b"\x00").endswith(JPEG_EOI):
+            return "truncated JPEG"
+        dimensions = _jpeg_size(body)
+    elif body[:8] == PNG_SIGNATURE:
+        if body[-8:] != PNG_IEND:
+            return "truncated PNG"
+        dimensions = (
+            int.from_bytes(body[16:20]),
+            int.from_bytes(body[20:24]),
+        )
+    else:
+        return "not a JPEG or PNG"
+    if size is not None and dimensions != tuple(size):
+        return f"{dimensions} is not {tuple(size)}"
+    return None
+
+
+def check_file(file: Path, size: tuple[int, int] | None = None) -> str | None:
+    """Check a cached tile, see check_tile()."""
+    try:
+        return check_tile(file.read_bytes(), size=size)
+    except OSError as e:
+        return str(e)
+
+
+def _write_files(batch: list) -> list:
+    """Store (file, body) pairs, returning an exception or None for each."""
+    errors = []
+    for file, body in batch:
+        try:
+            blob_store(file.parent).store(file, body)
+        except OSError as e:
+            errors.append(e)
+        else:
+            errors.append(None)
+    return errors
+
+
+class TileWriter:
+    """Batch tile writes into a small dedicated thread pool.
+
+    Bodies are streamed into pooled bytearrays rather than fresh bytes
+    objects. Every tile finished in the same event loop tick is written by
+    one thread pool job, instead of one aiofiles thread hop per write.
+    """
+
+    def __init__(self, workers: int = 2):
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix="tilewriter",
+        )
+        self._free: list[bytearray] = []
+        self._pending: list = []
+        self._pending_bytes = 0
+        self._scheduled = False
+        self._unsaved: set[BlobStore | Validators] = set()
+        # Keep the batch write tasks alive until they finish.
+        self._tasks: set[asyncio.Task] = set()
+
+    def acquire(self, length: int | None = None) -> bytearray:
+        """Return a buffer to stream a tile body of about length bytes into."""
+        if length is not None and length > BUFFER_SIZE:
+            return bytearray(length)
+        if self._free:
+            return self._free.pop()
+        return bytearray(BUFFER_SIZE)
+
+    def release(self, buffer: bytearray):
+        """Return a buffer to the pool once nothing references it."""
+        # Oversized and grown buffers are dropped rather than kept.
+        if len(buffer) == BUFFER_SIZE and len(self._free) < MAX_FREE_BUFFERS:
+            self._free.append(buffer)
+
+    async def write(self, file: Path, buffer: bytearray, size: int):
+        """Write the first size bytes of buffer to file, then release it."""
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+        self._pending.append((file, buffer, size, done))
+        self._pending_bytes += size
+        if self._pending_bytes >= BATCH_BYTES:
+            self._flush()
+        elif not self._scheduled:
+            # Let the other tiles finishing this tick join the batch.
+            self._scheduled = True
+            loop.call_soon(self._flush)
+        await done
+
+    def save_soon(self, store: BlobStore | Validators):
+        """Save a changed store within SAVE_INTERVAL, along with any others.
+
+        Anything still unsaved when the process exits is saved then.
+        """
+        if not self._unsaved:
+            loop = asyncio.get_running_loop()
+            loop.call_later(SAVE_INTERVAL, self._save)
+        self._unsaved.add(store)
+
+    def _save(self):
+        stores, self._unsaved = self._unsaved, set()
+        for store in stores:
+            self._executor.submit(store.save)
+
+    def _flush(self):
+        batch, self._pending = self._pending, []
+        self._pending_bytes = 0
+        self._scheduled = False
+        if batch:
+            task = asyncio.ensure_future(self._write_batch(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _write_batch(self, batch: list):
+        loop = asyncio.get_running_loop()
+        views = [memoryview(buffer)[:size] for _, buffer, size, _ in batch]
+        try:
+            errors = await loop.run_in_executor(
+                self._executor,
+                _write_files,
+                [(file, view) for (file, *_), view in zip(batch, views, strict=True)],
+            )
+        except Exception as e:
+            errors = [e] * len(batch)
+        for view in views:
+            view.release()
+        for directory in {file.parent for file, *_ in batch}:
+            self.save_soon(blob_store(directory))
+            self.save_soon(validators(directory))
+        for (_, buffer, _, done), error in zip(batch, errors, strict=True):
+            self.release(buffer)
+            if done.done():
+                continue
+            if error is None:
+                done.set_result(None)
+            else:
+                done.set_exception(error)
+
+
+# Shared by every downloader running in this process.
+WRITER = TileWriter()
+
+
+def save_all():
+    """Save every blob index and validators file changed in this process.
+
+    This happens anyway at exit; call it to make the changes visible to
+    other processes sooner.
+    """
+    save_indexes()
+    save_validators()
+
+
+async def stream_to_cache(
+    client: Transport,
+    tile: Tile,
+    conditional: bool = False,
+) -> str | None:
+    """Stream a tile into the cache, returning why it failed, if it did.
+
+    The body is validated before it is written, so only complete tiles
+    ever appear in the cache. If conditional, the cached copy is only
+    replaced if the server says it has changed.
+    """
+    store = validators(tile.file.parent)
+    headers = store.conditions(tile.file) if conditional else {}
+    buffer = None
+    size = 0
+    try:
+        async with client.stream(tile.url, headers=headers) as r:
+            if r.status_code == 304 and headers:
+                store.record(tile.file, r.headers)
+                WRITER.save_soon(store)
+                return None
+            if r.status_code != 200:
+                return f"HTTP {r.status_code}"
+            length = None
+            # A compressed transfer is decoded, so its length won't match.
+            if "content-length" in r.headers and "content-encoding" not in r.headers:
+                length = int(r.headers["content-length"])
+            # Taken only once the body is coming, and sized to fit it.
+            buffer = WRITER.acquire(length)
+            async for chunk in r.aiter_bytes():
+                end = size + len(chunk)
+                if end > len(buffer):
+                    buffer.extend(bytes(end - len(buffer)))
+                buffer[size:end] = chunk
+                size = end
+    except BaseException:
+        if buffer is not None:
+            WRITER.release(buffer)
+        raise
+    with memoryview(buffer) as view:
+        error = check_tile(view[:size], length, tile.size)
+    if error:
+        WRITER.release(buffer)
+        return error
+    # Saved on the writer's timer once the tile is written.
+    store.record(tile.file, r.headers)
+    await WRITER.write(tile.file, buffer, size)
+    tile.written = True
+    return None
+
+
+def retryable(error: str | None) -> bool:
+    """Return whether a tile that failed with error is worth trying again.
+
+    Transport errors, 5xx responses and bad bodies are; a 404 or 403
+    (e.g. past the edge of an S3 tileset) will only say the same again.
+    """
+    if error and error.startswith("HTTP 4"):
+        return int(error.removeprefix("HTTP ")) in RETRY_STATUSES
+    return True
+
+
+async def download(
+    client: Transport,
+    tile: Tile,
+    retries: int = 2,
+    delay: float = 5,
+    refresh: bool = False,
+) -> bool:
+    """Download a tile into the cache unless it is already there.
+
+    With refresh, a cached tile is revalidated and replaced if changed.
+    """
+    # Re-check inside the flight: another job may have just written it.
+    if not refresh and tile.file.exists():
+        return True
+    for retry in range(retries + 1):
+        try:
+            error = await stream_to_cache(client, tile, refresh)
+        except (httpx.TransportError, OSError) as e:
+            # Timeouts, resets and failed writes are retried and requeued
+            # like bad tiles, rather than killing the consumer.
+            error = f"{type(e).__name__}: {e}" if str(e) else type(e).__name__
+        if error is None:
+            if retry:
+                sys.stderr.write("*")  # * = Needed a retry
+            else:
+                sys.stderr.write("#")  # # = OK
+            return True
+        tile.error = error
+        if not retryable(error):
+            break
+        if retry < retries:
+            await asyncio.sleep(delay)
+    return False
+
+
+async def cache_tile(
+    client: Transport,
+    tile: Tile,
+    retries: int = 2,
+    verify: bool = False,
+    refresh: bool = False,
+) -> bool:
+    """Make sure a tile is cached, sharing any download already in flight.
+
+    Tiles are validated as they are written, so a cached tile is trusted
+    unless verify is set, e.g. for a cache written by an older version.
+    With refresh, a cached tile past its max-age is revalidated with a
+    conditional request, so it is only downloaded again if it changed.
+    """
+    file = tile.file
+    if file.exists() and verify and check_file(file, tile.size) is not None:
+        file.unlink(missing_ok=True)
+    if file.exists():
+        if not refresh or validators(file.parent).fresh(file):
+            return True
+    else:
+        refresh = False
+    return await FLIGHTS.do(
+        file,
+        partial(download, client, tile, retries, refresh=refresh),
+    )
@@ -0,0 +1,170 @@
+"""Compact tile descriptors for large grids."""
+
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+
+class TileGrid:
+    """What every tile of one image shares, so no tile has to hold it.
+
+    name(tile) and url(tile) format a tile's cache filename and URL. They
+    are only called when a tile's file or url is asked for, so a job of a
+    hundred thousand tiles holds no strings or paths until it is fetched.
+    For pickling (e.g. xyz2 shards) they should be module-level functions
+    or partials of them.
+    """
+
+    __slots__ = (
+        "tmpdir",
+        "width",
+        "height",
+        "tile_width",
+        "tile_height",
+        "name",
+        "url",
+        "startx",
+        "starty",
+        "zoom",
+    )
+
+    def __init__(
+        self,
+        tmpdir: Path,
+        size: tuple[int, int],
+        tile_size: tuple[int, int],
+        name: Callable[["Tile"], str],
+        url: Callable[["Tile"], str],
+        start: tuple[int, int] = (0, 0),
+        zoom: int | None = None,
+    ):
+        self.tmpdir = tmpdir
+        self.width, self.height = size
+        self.tile_width, self.tile_height = tile_size
+        self.name = name
+        self.url = url
+        # The source's index of the top left tile, for XYZ grids.
+        self.startx, self.starty = start
+        self.zoom = zoom
+
+    def tiles(self, cells: Iterable[tuple[int, int]]) -> list["Tile"]:
+        """Return a Tile for each (col, row)."""
+        return [Tile(self, col, row) for col, row in cells]
+
+
+class Tile:
+    """One tile of a TileGrid.
+
+    Only the grid, column and row are stored; x, y, size, file and url are
+    worked out when read. The other slots hold its download state.
+    """
+
+    __slots__ = (
+        "grid",
+        "col",
+        "row",
+        "error",
+        "requeues",
+        "cached",
+        "written",
+        "canvas",
+    )
+
+    def __init__(self, grid: TileGrid, col: int, row: int):
+        self.grid = grid
+        self.col = col
+        self.row = row
+        self.error: str | None = None
+        self.requeues = 0
+        self.cached = False
+        # Whether its file was (re)written, rather than found or revalidated.
+        self.written = False
+        # The manifest canvas this tile belongs to, if any.
+        self.canvas: dict | None = None
+
+    @property
+    def x(self) -> int:
+        return self.col * self.grid.tile_width
+
+    @property
+    def y(self) -> int:
+        return self.row * self.grid.tile_height
+
+    @property
+    def z(self) -> int | None:
+        return self.grid.zoom
+
+    @property
+    def tile_x(self) -> int:
+        """The source's x index of this tile, for XYZ URLs."""
+        return self.grid.startx + self.col
+
+    @property
+    def tile_y(self) -> int:
+        """The source's y index of this tile, for XYZ URLs."""
+        return self.grid.starty + self.row
+
+    @property
+    def size(self) -> tuple[int, int]:
+        # The right-most and bottom-most tiles are cut short by the image.
+        return (
+            min(self.grid.tile_width, self.grid.width - self.x),
+            min(self.grid.tile_height, self.grid.height - self.y),
+        )
+
+    @property
+    def file(self) -> Path:
+        return self.grid.tmpdir / self.grid.name(self)
+
+    @property
+    def url(self) -> str:
+        return self.grid.url(self)
+
+    def __repr__(self) -> str:
+        return f"Tile({self.col}, {self.row}, {self.file})"
+
+
+def xyz_url(template: str, tile: Tile) -> str:
+    """Fill in an XYZ URL template's {x}, {y} and {z} for a tile."""
+    return (
+        template.replace("{x}", str(tile.tile_x))
+        .replace("{y}", str(tile.tile_y))
+        .replace("{z}", str(tile.z))
+    )
+
+
+def tile_url(
+    base_url: str,
+    scale: int,
+    img_type: str,
+    x: int,
+    y: int,
+    width: int,
+    height: int,
+    level0: bool = False,
+) -> str:
+    """Generate the IIIF Image API URL for a tile image."""
+    # Level 0 servers only have the pre-cut tiles, named by width alone.
+    size = f"{width}," if level0 else f"{width},{height}"
+    return f"{base_url}/{x},{y},{width},{height}/{size}/{scale}/default.{img_type}"
+
+
+def iiif_url(
+    base_url: str,
+    scale: int,
+    img_type: str,
+    tile: Tile,
+    level0: bool = False,
+) -> str:
+    """Generate the IIIF Image API URL for a TileGrid tile."""
+    width, height = tile.size
+    return tile_url(base_url, scale, img_type, tile.x, tile.y, width, height, level0)
+
+
+def iiif_name(path: str, img_type: str, tile: Tile) -> str:
+    """Generate the cache filename for a tile, by its pixel position."""
+    return f"{path}_{tile.x}_{tile.y}.{img_type}"
+
+
+def xyz_name(path: str, img_type: str, tile: Tile) -> str:
+    """Generate the cache filename for a tile, by its XYZ index."""
+    return f"{path}_{tile.tile_x}_{tile.tile_y}.{img_type}"
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""Shared HTTP transport for the tile downloaders."""
+
+import argparse
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
+
+import httpx
+
+# Settings for any host not listed in HOSTS.
+DEFAULT_HOST = {
+    "http2": True,
+    "max_connections": 20,
+    "max_keepalive": 10,
+    "keepalive_expiry": 30.0,
+    # In-flight requests per host, i.e. HTTP/2 streams when multiplexing.
+    "max_streams": 100,
+}
+
+# Per-host overrides. S3 only speaks HTTP/1.1, so it needs many connections;
+# the NLS IIIF servers multiplex well but throttle clients that open many.
+HOSTS = {
+    "mapseries-tilesets.s3.amazonaws.com": {
+        "http2": False,
+        "max_connections": 100,
+        "max_keepalive": 100,
+    },
+    "map-view.nls.uk": {"max_connections": 4, "max_streams": 64},
+    "maps.nls.uk": {"max_connections": 4, "max_streams": 64},
+}
+
+TIMEOUT = {"connect": 10.0, "read": 30.0, "write": 30.0, "pool": 60.0}
+
+BACKENDS = ("httpx", "curl")
+
+
+def host_config(host: str, hosts: dict | None = None) -> dict:
+    """Return the settings for a host, defaults filled in."""
+    hosts = HOSTS if hosts is None else hosts
+    return DEFAULT_HOST | hosts.get(host, {})
+
+
+def _limits(config: dict) -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=config["max_connections"],
+        max_keepalive_connections=config["max_keepalive"],
+        keepalive_expiry=config["keepalive_expiry"],
+    )
+
+
+class Transport:
+    """HTTP client shared by every downloader in a process.
+
+    Wraps either an httpx.AsyncClient, with one connection pool mounted per
+    configured host, or a curl_cffi AsyncSession. Either way requests are
+    capped per host at max_streams and responses come back as
+    httpx.Response, so callers need not care which backend is in use.
+    """
+
+    def __init__(
+        self,
+        backend: str = "httpx",
+        hosts: dict | None = None,
+        timeout: dict | None = None,
+        http2: bool | None = None,
+    ):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, expected {BACKENDS}")
+        self.backend = backend
+        self.hosts = HOSTS if hosts is None else hosts
+        self.timeout = TIMEOUT if timeout is None else timeout
+        # Force HTTP/1.1 or HTTP/2 for every host, e.g. when benchmarking.
+        self.http2 = http2
+        self._streams: dict[str, asyncio.Semaphore] = {}
+        self._client = None
+
+    def config(self, host: str) -> dict:
+        """Return the effective settings for a host."""
+        config = host_config(host, self.hosts)
+        if self.http2 is not None:
+            config["http2"] = self.http2
+        return config
+
+    async def __aenter__(self):
+        if self.backend == "curl":
+            # Imported lazily so the httpx backend works without libcurl.
+            from curl_cffi.requests import AsyncSession
+
+            self._client = AsyncSession(
+                max_clients=sum(
+                    self.config(host)["max_connections"] for host in [*self.hosts, ""]
+                ),
+                timeout=(self.timeout["connect"], self.timeout["read"]),
+            )
+        else:
+            default = self.config("")
+            self._client = httpx.AsyncClient(
+                http2=default["http2"],
+                limits=_limits(default),
+                timeout=httpx.Timeout(**self.timeout),
+                mounts={
+                    f"all://{host}": httpx.AsyncHTTPTransport(
+                        http2=self.config(host)["http2"],
+                        limits=_limits(self.config(host)),
+                    )
+                    for host in self.hosts
+                },
+            )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.aclose()
+
+    async def aclose(self):
+        """Close every pooled connection."""
+        if self._client is None:
+            return
+        if self.backend == "curl":
+            await self._client.close()
+        else:
+            await self._client.aclose()
+        self._client = None
+
+    def _semaphore(self, host: str) -> asyncio.Semaphore:
+        if host not in self._streams:
+            self._streams[host] = asyncio.Semaphore(self.config(host)["max_streams"])
+        return self._streams[host]
+
+    async def _curl_get(self, url: str, **kwargs) -> httpx.Response:
+        from curl_cffi import CurlError, CurlHttpVersion
+
+        if self.config(urlsplit(url).hostname)["http2"]:
+            http_version = CurlHttpVersion.V2_0
+        else:
+            http_version = CurlHttpVersion.V1_1
+        try:
+            r = await self._client.get(url, http_version=http_version, **kwargs)
+        except CurlError as e:
+            # Surface it as httpx's, so callers only have one kind to catch.
+            raise httpx.TransportError(str(e)) from e
+        # curl has already decoded the body, so drop the encoding headers
+        # or httpx would try to decode it a second time, and the encoded
+        # length, which httpx replaces with the decoded body's.
+        headers = [
+            (k, v)
+            for k, v in r.headers.items()
+            if k.lower()
+            not in ("content-encoding", "transfer-encoding", "content-length")
+        ]
+        return httpx.Response(
+            r.status_code,
+            headers=headers,
+            content=r.content,
+            request=httpx.Request("GET", url),
+        )
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        """GET a URL, respecting the host's stream limit."""
+        async with self._semaphore(urlsplit(url).hostname):
+            if self.backend == "curl":
+                return await self._curl_get(url, **kwargs)
+            return await self._client.get(url, **kwargs)
+
+    @asynccontextmanager
+    async def stream(self, url: str, **kwargs):
+        """GET a URL without reading the body, for use with aiter_bytes().
+
+        The curl backend has no incremental body, so it yields a response
+        whose body is already in memory; aiter_bytes() still works on it.
+        """
+        async with self._semaphore(urlsplit(url).hostname):
+            if self.backend == "curl":
+                yield await self._curl_get(url, **kwargs)
+                return
+            async with self._client.stream("GET", url, **kwargs) as r:
+                yield r
+
+
+async def _fetch_all(transport: Transport, urls: list) -> tuple[int, int]:
+    """Fetch every URL, returning the bytes received and failures."""
+    results = await asyncio.gather(
+        *(transport.get(url) for url in urls),
+        return_exceptions=True,
+    )
+    received = 0
+    failed = 0
+    for r in results:
+        if isinstance(r, httpx.Response) and r.is_success:
+            received += len(r.content)
+        else:
+            failed += 1
+    return received, failed
+
+
+async def benchmark(urls: list, backends: list) -> list:
+    """Time each (name, Transport) against the same list of tile URLs."""
+    results = []
+    for name, transport in backends:
+        async with transport:
+            started_at = time.monotonic()
+            received, failed = await _fetch_all(transport, urls)
+            took = time.monotonic() - started_at
+        results.append(
+            {
+                "name": name,
+                "seconds": took,
+                "tiles": len(urls),
+                "failed": failed,
+                "bytes": received,
+            },
+        )
+        print(
+            f"{name:>10}: {len(urls)} tiles in {took:.2f}s "
+            f"({len(urls) / took:.1f} tiles/s, {received / took / 1e6:.2f} MB/s, "
+            f"{failed} failed)",
+        )
+    return results
+
+
+async def main(imageurl: str, count: int):
+    """Benchmark each backend on the first tiles of an IIIF image."""
+    from tiles import tile_url
+
+    async with Transport() as client:
+        image_data = (await client.get(imageurl)).json()
+    base_url = image_data.get("id", image_data.get("@id"))
+    tile_width: int = image_data["tiles"][0]["width"]
+    tile_height: int = image_data["tiles"][0]["height"]
+    scale_factor: int = min(image_data["tiles"][0]["scaleFactors"])
+    scale: int = image_data["tiles"][0]["scaleFactors"].index(scale_factor)
+    urls = []
+    for x in range(0, image_data["width"], tile_width):
+        for y in range(0, image_data["height"], tile_height):
+            this_tile_width = min(tile_width, image_data["width"] - x)
+            this_tile_height = min(tile_height, image_data["height"] - y)
+            urls.append(
+                tile_url(
+                    base_url,
+                    scale,
+                    "jpg",
+                    x,
+                    y,
+                    this_tile_width,
+                    this_tile_height,
+                ),
+            )
+    urls = urls[:count]
+    print(f"Benchmarking {len(urls)} tiles from {imageurl}:")
+    await benchmark(
+        urls,
+        [
+            ("httpx-h2", Transport(http2=True)),
+            ("httpx-h1", Transport(http2=False)),
+            ("curl-h2", Transport(backend="curl", http2=True)),
+            ("curl-h1", Transport(backend="curl", http2=False)),
+        ],
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(prog="transport", usage="%(prog)s [options]")
+    parser.add_argument(
+        "--url",
+        help="IIIF info.json URL to take the benchmark tiles from.",
+        default="https://map-view.nls.uk/iiif/2/10234%2F102345876/info.json",
+    )
+    parser.add_argument(
+        "--tiles",
+        help="Number of tiles to fetch with each backend.",
+        type=int,
+        default=200,
+    )
+    args = parser.parse_args()
+    asyncio.run(main(args.url, args.tiles))
@@ -0,0 +1,159 @@
+"""Remember HTTP validators for cached files, so they can be revalidated."""
+
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from email.utils import formatdate
+from pathlib import Path
+
+from blobstore import locked
+
+# Rewrite a log longer than this once most of its lines are superseded.
+COMPACT_LINES = 10_000
+
+
+def max_age(headers) -> float | None:
+    """Return how many more seconds a response may be used without asking."""
+    cache_control = headers.get("cache-control", "").lower()
+    if "no-cache" in cache_control or "no-store" in cache_control:
+        return 0
+    match = re.search(r"max-age=(\d+)", cache_control)
+    if not match:
+        return None
+    try:
+        age = int(headers.get("age", 0))
+    except ValueError:
+        age = 0
+    return max(int(match.group(1)) - age, 0)
+
+
+class Validators:
+    """The ETag, Last-Modified and expiry of each cached file in a directory.
+
+    They are kept in validators.jsonl beside the files, a log of
+    [file name, validators] lines where the last line for a file wins.
+    New lines are appended on save, so saving costs what changed rather
+    than the whole directory, and processes sharing the directory only
+    lock each other out for the append. The log is rewritten once it is
+    mostly superseded lines.
+    """
+
+    def __init__(self, directory: Path):
+        self.file = directory / "validators.jsonl"
+        self.lock_file = directory / "validators.lock"
+        self._lock = threading.Lock()
+        self._unsaved: list = []
+        self.entries, lines = self._read()
+        if lines > max(COMPACT_LINES, 2 * len(self.entries)):
+            self._compact()
+
+    def _read(self) -> tuple[dict, int]:
+        """Replay the log, returning its entries and how many lines it had."""
+        entries = {}
+        lines = 0
+        try:
+            with open(self.file) as f:
+                for line in f:
+                    try:
+                        name, entry = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short by a crash.
+                    entries[name] = entry
+                    lines += 1
+        except OSError:
+            pass
+        return entries, lines
+
+    def _compact(self):
+        with locked(self.lock_file):
+            # Re-read, to keep lines other processes have appended since.
+            self.entries, _ = self._read()
+            part = self.file.with_name(f"{self.file.name}.{os.getpid()}.part")
+            with open(part, "w") as f:
+                f.writelines(
+                    json.dumps([name, entry]) + "\n"
+                    for name, entry in self.entries.items()
+                )
+            part.replace(self.file)
+
+    def record(self, file: Path, headers):
+        """Remember the validators a response for file came with."""
+        age = max_age(headers)
+        with self._lock:
+            # A 304 need not repeat them, so keep what we had.
+            entry = dict(self.entries.get(file.name, {}))
+            if "etag" in headers:
+                entry["etag"] = headers["etag"]
+            if "last-modified" in headers:
+                entry["last_modified"] = headers["last-modified"]
+            if age is None:
+                entry.pop("expires", None)
+            else:
+                entry["expires"] = round(time.time() + age)
+            if entry == self.entries.get(file.name, {}):
+                return
+            self.entries[file.name] = entry
+            self._unsaved.append([file.name, entry])
+
+    def fresh(self, file: Path) -> bool:
+        """Return True if file may still be used without revalidating it."""
+        entry = self.entries.get(file.name, {})
+        return entry.get("expires", 0) > time.time()
+
+    def conditions(self, file: Path) -> dict:
+        """Return the headers to revalidate a cached file with.
+
+        Files cached without validators are checked against their
+        modification time instead.
+        """
+        entry = self.entries.get(file.name, {})
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        elif not headers and file.exists():
+            headers["If-Modified-Since"] = formatdate(
+                file.stat().st_mtime,
+                usegmt=True,
+            )
+        return headers
+
+    def save(self):
+        """Append anything recorded since the last save to the log."""
+        with self._lock:
+            lines, self._unsaved = self._unsaved, []
+        if not lines:
+            return
+        text = "".join(json.dumps(line) + "\n" for line in lines)
+        with locked(self.lock_file), open(self.file, "a") as f:
+            f.write(text)
+
+
+_stores: dict[Path, Validators] = {}
+_stores_lock = threading.Lock()
+
+
+def validators(directory: Path) -> Validators:
+    """Return the shared Validators for a directory."""
+    with _stores_lock:
+        if directory not in _stores:
+            _stores[directory] = Validators(directory)
+        return _stores[directory]
+
+
+@atexit.register
+def save_all():
+    """Save every directory's validators that have changed.
+
+    Directories that have since been removed are dropped instead.
+    """
+    with _stores_lock:
+        for directory in [d for d in _stores if not d.exists()]:
+            del _stores[directory]
+        stores = list(_stores.values())
+    for store in stores:
+        store.save()
@@ -6,68 +6,70 @@ import asyncio
 import json
 import sys
 import time
+from functools import partial
 from pathlib import Path
 
 import aiofiles
-import httpx
-from PIL import Image
+
+from encode import describe, save_image
+from montage import build_montage
+from schedule import ORDERS, Budget, order_grid
+from tilecache import MAX_REQUEUES, cache_tile, retryable
+from tiles import TileGrid, xyz_name, xyz_url
+from transport import BACKENDS, Transport
 
 QUEUE_SIZE = 16
 
 
-async def consumer(queue: asyncio.Queue, client: httpx.AsyncClient):
+async def consumer(
+    queue: asyncio.Queue,
+    client: Transport,
+    verify: bool = False,
+    budget: Budget | None = None,
+    refresh: bool = False,
+):
     """Process tiles from the queue."""
     while True:
         tile = await queue.get()
-        if not tile["file"].exists():
-            for retry in range(2):
-                r = await client.get(tile.get("url"))
-                if r.status_code == 200:
-                    if retry:
-                        sys.stderr.write("*")
-                    else:
-                        sys.stderr.write("#")
-                async with aiofiles.open(tile["file"], mode="wb") as img:
-                    await img.write(r.content)
-                break  # Exit from retry loop
+        if budget and not budget.allow(tile):
+            sys.stderr.write(".")  # Out of time or requests, leave it missing
+        elif not await cache_tile(
+            client,
+            tile,
+            retries=1,
+            verify=verify,
+            refresh=refresh,
+        ):
+            tile.requeues += 1
+            if tile.requeues <= MAX_REQUEUES and retryable(tile.error):
+                # Try it again once the rest of the queue has had a go.
+                queue.put_nowait(tile)
             else:
                 sys.stderr.write("!")
-                await asyncio.sleep(5)
 
         sys.stderr.flush()
         queue.task_done()
 
 
-def tile_url(
-    base_url: str,
-    scale: int,
-    img_type: str,
-    x: int,
-    y: int,
-    width: int,
-    height: int,
-) -> str:
-    """Generate the URL for a tile image."""
-    return (
-        f"{base_url}/"
-        f"{x},{y},{width},{height}/"
-        f"{width},{height}/{scale}/default.{img_type}"
-    )
-
-
-def tile_filename(path: str, img_type: str, x: int, y: int) -> str:
-    """Generate the filename for a tile image."""
-    return f"{path}_{x}_{y}.{img_type}"
-
+async def main(
+    file: str,
+    output_path: str,
+    backend: str = "httpx",
+    verify: bool = False,
+    order: str = "column",
+    budget: Budget | None = None,
+    refresh: bool = False,
+):
+    """Download IIF tiles and create a montage image.
 
-async def main(file: str, output_path: str):
-    """Download IIF tiles and create a montage image."""
+    Tiles are fetched in the given order until any budget runs out; with
+    refresh, cached tiles are revalidated rather than trusted."""
     queue = asyncio.Queue()
 
     tmpdir = Path("tiles")
     tmpdir.mkdir(exist_ok=True)
 
-    async with httpx.AsyncClient(http2=True) as client:
+    async with Transport(backend) as client:
         async with aiofiles.open(file, mode="r") as image_data_file:
             image_data_contents = await image_data_file.read()
 
@@ -88,27 +90,27 @@ async def main(file: str, output_path: str):
             tile_height = 256
             scale = image_data["overlays"][0]["overlay"]["max_zoom"]
             img_type = base_url.split(".")[-1]
-            tiles = []
+            grid = TileGrid(
+                tmpdir,
+                (image_data["width"], image_data["height"]),
+                (tile_width, tile_height),
+                partial(xyz_name, path, img_type),
+                partial(xyz_url, base_url),
+                start=(startx, starty),
+                zoom=scale,
+            )
             tasks = []
 
             for _ in range(QUEUE_SIZE):
-                tasks.append(asyncio.create_task(consumer(queue, client)))
-
-            for x in range(startx, endx):
-                for y in range(starty, endy):
-                    tile = {
-                        "x": tile_width * (x - startx),
-                        "y": tile_height * (y - starty),
-                        "z": scale,
-                    }
-                    tile["file"] = Path(tmpdir, tile_filename(path, img_type, x, y))
-                    tile["url"] = (
-                        base_url.replace("{x}", str(x))
-                        .replace("{y}", str(y))
-                        .replace("{z}", str(scale))
-                    )
-                    tiles.append(tile)
-                    queue.put_nowait(tile)
+                tasks.append(
+                    asyncio.create_task(
+                        consumer(queue, client, verify, budget, refresh),
+                    ),
+                )
+
+            tiles = grid.tiles(order_grid(endx - startx, endy - starty, order))
+            for tile in tiles:
+                queue.put_nowait(tile)
 
             await queue.join()
 
@@ -119,17 +121,9 @@ async def main(file: str, output_path: str):
 
         print()
         print(f"Creating montage {output_path}")
-        montage = Image.new("RGB", (image_data["width"], image_data["height"]))
-        for tile in tiles:
-            try:
-                with Image.open(tile["file"]) as im:
-                    montage.paste(im, (tile["x"], tile["y"]))
-            except Exception as e:
-                print(f"Error processing {tile['file']}: {e}")
-            finally:
-                continue
-        montage.save(output_path)
-        print(f"Montage saved to {output_path}")
+        montage = build_montage(image_data["width"], image_data["height"], tiles)
+        report = save_image(montage, output_path)
+        print(f"Montage saved to {output_path}: {describe(report)}")
 
 
 if __name__ == "__main__":
@@ -141,6 +135,38 @@ if __name__ == "__main__":
         default=("1940s.json"),
     )
     parser.add_argument("--output", help="Output filename")
+    parser.add_argument(
+        "--backend",
+        help="HTTP backend",
+        choices=BACKENDS,
+        default="httpx",
+    )
+    parser.add_argument(
+        "--verify",
+        help="Re-check cached tiles and refetch any that are corrupt",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--order",
+        help="Order to fetch tiles in",
+        choices=ORDERS,
+        default="column",
+    )
+    parser.add_argument(
+        "--seconds",
+        help="Stop fetching new tiles after this many seconds",
+        type=float,
+    )
+    parser.add_argument(
+        "--requests",
+        help="Stop fetching new tiles after this many requests",
+        type=int,
+    )
+    parser.add_argument(
+        "--refresh",
+        help="Revalidate cached tiles with the server, refetching changed ones",
+        action="store_true",
+    )
     args = parser.parse_args()
     # Use provided manifest URL or default to example
     xyzfile = args.xyz
@@ -148,6 +174,16 @@ if __name__ == "__main__":
         output_path = args.output
     else:
         output_path = "output.jpg"
-    asyncio.run(main(xyzfile, output_path))
+    asyncio.run(
+        main(
+            xyzfile,
+            output_path,
+            args.backend,
+            args.verify,
+            args.order,
+            Budget(args.seconds, args.requests),
+            args.refresh,
+        ),
+    )
     total_slept_for = time.monotonic() - started_at
     print(f"{QUEUE_SIZE} workers took {total_slept_for:.2f} seconds")
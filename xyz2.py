@@ -6,86 +6,184 @@ import asyncio
 import json
 import sys
 import time
+from collections import deque
+from functools import partial
 from pathlib import Path
 
 import aiofiles
-import httpx
 from PIL import Image
 
+from composite import blend, composite_cell
+from encode import describe, save_image
+from geotiff import write_geotiff, xyz_transform
+from montage import build_montage
+from schedule import ORDERS, OVER_BUDGET, Budget, order_grid
+from shard import run_shards, split
+from tilecache import MAX_REQUEUES, cache_tile, retryable, save_all
+from tiles import Tile, TileGrid, xyz_name, xyz_url
+from transport import BACKENDS, Transport
+
 QUEUE_SIZE = 1000
 
+TILE_DIR = Path("tiles")
+
 
 # Simple approach - no queue - just request with retry logic
-async def fetch_tile(session, tile):
-    """Request the tiles data and save it to the filename.
-    If request is unsuccessful try up to 2 times with a
-    short pause."""
+async def fetch_tile(
+    session,
+    tile,
+    verify: bool = False,
+    budget: Budget | None = None,
+    refresh: bool = False,
+):
+    """Fetch a tile, sharing any download already in flight for it."""
 
-    if tile["file"].exists() and tile["file"].stat().st_size > 0:
+    if not verify and not refresh and tile.file.exists():
         sys.stderr.write("-")  # Skipped
+        tile.cached = True
+    elif budget and not budget.allow(tile):
+        sys.stderr.write(".")  # Out of time or requests, leave it missing
+        tile.cached = False
     else:
-        retry = 0
-        while retry <= 2:
-            response = await session.get(tile.get("url"))
-            if response.is_success:
-                if not retry:
-                    sys.stderr.write("#")  # # = OK
-                else:
-                    sys.stderr.write("*")  # * = Need to retry URL
-                async with aiofiles.open(tile["file"], mode="wb") as img_file:
-                    await img_file.write(response.content)
-                break  # From while loop
-            else:
-                retry += 1
-                await asyncio.sleep(5)
-        else:
-            sys.stderr.write("!")  # Couldn't download tile
-            return
+        tile.cached = await cache_tile(
+            session,
+            tile,
+            verify=verify,
+            refresh=refresh,
+        )
 
     sys.stderr.flush()
     return tile
 
 
-async def generate_tiles(tmpdir: Path, image_data: dict):
-    """Generator for all the tiles in the xyz map dataset
-    to download."""
+def grid_cells(image_data: dict, order: str = "column") -> list:
+    """Return every (col, row) of the grid in the given order."""
+    columns = image_data["endx"] - image_data["startx"]
+    rows = image_data["endy"] - image_data["starty"]
+    return order_grid(columns, rows, order)
 
-    for x in range(image_data["startx"], image_data["endx"]):
-        for y in range(image_data["starty"], image_data["endy"]):
-            tile = {
-                "x": image_data["tile_width"] * (x - image_data["startx"]),
-                "y": image_data["tile_height"] * (y - image_data["starty"]),
-                "z": image_data["scale"],
-            }
 
-            tile["file"] = Path(
+def layer_grids(tmpdir: Path, image_data: dict) -> list[tuple[TileGrid, float]]:
+    """Return each layer's TileGrid and opacity, bottom first."""
+    tile_size = (image_data["tile_width"], image_data["tile_height"])
+    columns = image_data["endx"] - image_data["startx"]
+    rows = image_data["endy"] - image_data["starty"]
+    return [
+        (
+            TileGrid(
                 tmpdir,
-                f"{image_data["path"]}_{x}_{y}.tmp",
-            )
-            tile["url"] = (
-                image_data["base_url"]
-                .replace("{x}", str(x))
-                .replace("{y}", str(y))
-                .replace("{z}", str(image_data["scale"]))
-            )
-            yield tile
+                (columns * tile_size[0], rows * tile_size[1]),
+                tile_size,
+                partial(xyz_name, layer["path"], "tmp"),
+                partial(xyz_url, layer["base_url"]),
+                start=(image_data["startx"], image_data["starty"]),
+                zoom=image_data["scale"],
+            ),
+            layer["opacity"],
+        )
+        for layer in image_data["layers"]
+    ]
+
+
+def grid_cell(layers: list, col: int, row: int) -> dict:
+    """Describe a grid cell for blending: where it goes and its layer tiles.
+
+    Built only when wanted, from the layers' grids, so nothing per cell
+    is held while its tiles download.
+    """
+    tiles = [(Tile(grid, col, row), opacity) for grid, opacity in layers]
+    first = tiles[0][0]
+    return {
+        "x": first.x,
+        "y": first.y,
+        "size": first.size,
+        "layers": [(tile.file, opacity) for tile, opacity in tiles],
+    }
+
+
+async def generate_tiles(
+    layers: list,
+    image_data: dict,
+    order: str = "column",
+    cells: list | None = None,
+):
+    """Generator for all the tiles in the xyz map dataset
+    to download, with the grid cells in the given order.
+
+    Every layer's tile for a grid cell is yielded together, so the cell
+    can be blended as soon as they are all in. cells, if given, is the
+    (col, row) list to fetch instead."""
+
+    for col, row in cells or grid_cells(image_data, order):
+        for grid, _ in layers:
+            yield Tile(grid, col, row)
+
+
+def tile_done(tile: Tile, layers: list, remaining: dict, on_cell=None):
+    """Count a tile off its grid cell, handing the cell on once complete.
+
+    remaining holds how many layer tiles are still to come for each cell
+    that has had some finish.
+    """
+    cell = (tile.col, tile.row)
+    remaining[cell] = remaining.get(cell, len(layers)) - 1
+    if not remaining[cell]:
+        del remaining[cell]
+        if on_cell:
+            on_cell(grid_cell(layers, *cell))
 
 
-async def download_tiles(image_data: dict) -> list:
-    """Download IIF tiles and create a montage image."""
+async def download_tiles(
+    image_data: dict,
+    backend: str = "httpx",
+    verify: bool = False,
+    on_cell=None,
+    order: str = "column",
+    budget: Budget | None = None,
+    cells: list | None = None,
+    shards: int = 1,
+    refresh: bool = False,
+) -> list:
+    """Download IIF tiles and create a montage image.
 
-    tmpdir = Path("tiles")
-    tmpdir.mkdir(exist_ok=True)
+    on_cell, if given, is called with each grid cell once all of its
+    layers' tiles have been fetched (or given up on). Tiles are fetched
+    in the given order until any budget runs out, and split across
+    shards processes if more than one. With refresh, cached tiles are
+    revalidated rather than trusted."""
+
+    if shards > 1:
+        return await download_sharded(
+            image_data,
+            shards,
+            backend,
+            verify,
+            on_cell,
+            order,
+            budget,
+            refresh,
+        )
+    TILE_DIR.mkdir(exist_ok=True)
+    layers = layer_grids(TILE_DIR, image_data)
+    done_cell = partial(tile_done, layers=layers, remaining={}, on_cell=on_cell)
     tasks = set()
-    todo = []
+    # First in, first out, so tiles are fetched in the scheduled order.
+    todo = deque()
     results = []
 
-    async with httpx.AsyncClient(http2=True) as session:
+    async with Transport(backend) as session:
+        fetch = partial(
+            fetch_tile,
+            session,
+            verify=verify,
+            budget=budget,
+            refresh=refresh,
+        )
         async with asyncio.TaskGroup() as tg:
             # Keep QUEUE_SIZE (1000) running at once
-            async for tile in generate_tiles(tmpdir, image_data):
+            async for tile in generate_tiles(layers, image_data, order, cells):
                 if len(tasks) < QUEUE_SIZE:
-                    tasks.add(tg.create_task(fetch_tile(session, tile)))
+                    tasks.add(tg.create_task(fetch(tile)))
                 else:
                     todo.append(tile)
 
@@ -97,24 +195,100 @@ async def download_tiles(image_data: dict) -> list:
                 )
 
                 for task in done:
-                    # Scedule a new task ASAP
-                    if todo:
-                        tasks.add(tg.create_task(fetch_tile(session, todo.pop())))
                     # Fail fast if there's an exception
                     if task.exception():
                         return []
-                    results.append(task.result())
+                    tile = task.result()
+                    if tile.cached or tile.error == OVER_BUDGET:
+                        # Tiles skipped for the budget show up as missing.
+                        results.append(tile)
+                        done_cell(tile)
+                    elif tile.requeues < MAX_REQUEUES and retryable(tile.error):
+                        # Try it again once the rest of the grid has had a go.
+                        tile.requeues += 1
+                        todo.append(tile)
+                    else:
+                        sys.stderr.write("!")  # Couldn't download tile
+                        done_cell(tile)
+                    # Schedule a new task ASAP
+                    if todo:
+                        tasks.add(tg.create_task(fetch(todo.popleft())))
 
     return results
 
 
-async def main(file: str, output_path: str):
-    """Download IIF tiles and create a montage image."""
+def download_shard(job: dict, report) -> list:
+    """Download one shard of the grid in a worker process.
+
+    Each finished cell is reported back to the coordinator as it is done.
+    """
+    tiles = asyncio.run(
+        download_tiles(
+            job["image_data"],
+            job["backend"],
+            job["verify"],
+            partial(report, "cell"),
+            budget=job["budget"],
+            cells=job["cells"],
+            refresh=job["refresh"],
+        ),
+    )
+    # Merge this shard's blob index and validators into the shared ones
+    # once, before the coordinator hears it is done and reads them.
+    save_all()
+    return tiles
+
+
+async def download_sharded(
+    image_data: dict,
+    shards: int,
+    backend: str = "httpx",
+    verify: bool = False,
+    on_cell=None,
+    order: str = "column",
+    budget: Budget | None = None,
+    refresh: bool = False,
+) -> list:
+    """Download the grid with a process, event loop and client per shard.
+
+    Each shard is a contiguous run of the ordered grid. The workers all
+    write into the shared tile store; finished cells are passed on to
+    on_cell here as they arrive, so the montage builds up meanwhile. If
+    a shard fails, the other shards' tiles are still returned."""
+
+    jobs = [
+        {
+            "image_data": image_data,
+            "cells": cells,
+            "backend": backend,
+            "verify": verify,
+            "budget": budget.share(shards, index) if budget else None,
+            "refresh": refresh,
+        }
+        for index, cells in enumerate(split(grid_cells(image_data, order), shards))
+    ]
+    done = [0] * shards
+
+    def on_message(index: int, kind: str, cell: dict):
+        done[index] += 1
+        if on_cell:
+            on_cell(cell)
+
+    results = await run_shards(download_shard, jobs, on_message)
+    print()
+    for index, job in enumerate(jobs):
+        status = "failed" if results[index] is None else "done"
+        print(f"Shard {index} {status}: {done[index]} of {len(job['cells'])} cells")
+    # A failed shard's cells are left missing, like tiles that failed.
+    return [tile for result in results if result is not None for tile in result]
+
+
+async def read_layers(file: str) -> tuple[list, int]:
+    """Read the overlays in an XYZ json file as layers, with their zoom."""
 
     async with aiofiles.open(file, mode="r") as image_data_file:
         image_file_contents = await image_data_file.read()
         image_json = json.loads(image_file_contents)
-        image_dict = {}
 
         if "data" in image_json and len(image_json["data"].get("result")) > 0:
             image_data = image_json["data"]["result"][0]
@@ -122,38 +296,187 @@ async def main(file: str, output_path: str):
             raise ValueError(f"No data found in {file}")
 
         if "overlays" in image_data and len(image_data["overlays"]) > 0:
-            overlays = image_data["overlays"][0]["overlay"]
+            overlays = [overlay["overlay"] for overlay in image_data["overlays"]]
         else:
             raise ValueError(f"No overlays found in {file}")
 
-        image_dict["base_url"] = overlays.get("url")
-        image_dict["scale"] = overlays.get("max_zoom")
+    slug = image_data.get("slug")
+    layers = [
+        {
+            "base_url": overlay.get("url"),
+            # The first overlay keeps the plain slug so existing caches hit.
+            "path": slug if not index else f"{slug}-{overlay.get('id')}",
+        }
+        for index, overlay in enumerate(overlays)
+    ]
+    return layers, overlays[0].get("max_zoom")
 
-        image_dict["path"] = image_data.get("slug")
-        image_dict["startx"] = 261808 - 9
-        # startx = 1047234 - 19
-        # endx = 1047385
-        image_dict["endx"] = image_dict["startx"] + 55
-        # starty = 697468 + 10
-        image_dict["starty"] = 174377 - 10
-        image_dict["endy"] = image_dict["starty"] + 38
-        image_dict["tile_width"] = 256
-        image_dict["tile_height"] = 256
+
+async def download_geotiff(
+    image_dict: dict,
+    output_path: str,
+    width: int,
+    height: int,
+    backend: str = "httpx",
+    verify: bool = False,
+    order: str = "column",
+    budget: Budget | None = None,
+    shards: int = 1,
+    refresh: bool = False,
+):
+    """Download the grid and write it as a GeoTIFF in EPSG:3857."""
+    layers = layer_grids(TILE_DIR, image_dict)
+    finished = set()
+
+    def on_cell(cell: dict):
+        finished.add((cell["x"], cell["y"]))
+
+    def pixels(x: int, y: int):
+        if (x, y) not in finished:
+            return None
+        cell = grid_cell(
+            layers,
+            x // image_dict["tile_width"],
+            y // image_dict["tile_height"],
+        )
+        return blend(cell["layers"], cell["size"])
+
+    if not await download_tiles(
+        image_dict,
+        backend,
+        verify,
+        on_cell,
+        order,
+        budget,
+        shards=shards,
+        refresh=refresh,
+    ):
+        return
+    print()
+    print(f"Creating GeoTIFF {output_path}")
+    write_geotiff(
+        output_path,
+        width,
+        height,
+        (image_dict["tile_width"], image_dict["tile_height"]),
+        pixels,
+        xyz_transform(
+            image_dict["startx"],
+            image_dict["starty"],
+            image_dict["scale"],
+            image_dict["tile_width"],
+        ),
+        3857,
+    )
+    print(f"GeoTIFF saved to {output_path}")
+
+
+async def main(
+    files: list,
+    output_path: str,
+    backend: str = "httpx",
+    verify: bool = False,
+    opacity: list | None = None,
+    geotiff: bool = False,
+    order: str = "column",
+    budget: Budget | None = None,
+    shards: int = 1,
+    refresh: bool = False,
+):
+    """Download IIF tiles and create a montage image.
+
+    Every overlay in every file becomes a layer, bottom first, and they
+    are blended into one image with the given per-layer opacity. Tiles
+    are fetched in the given order until any budget runs out."""
+
+    image_dict = {"layers": []}
+    for file in files:
+        layers, scale = await read_layers(file)
+        image_dict["layers"].extend(layers)
+        # The grid uses the zoom of the bottom layer.
+        image_dict.setdefault("scale", scale)
+    opacity = opacity or []
+    for index, layer in enumerate(image_dict["layers"]):
+        layer["opacity"] = opacity[index] if index < len(opacity) else 1.0
+
+    image_dict["startx"] = 261808 - 9
+    # startx = 1047234 - 19
+    # endx = 1047385
+    image_dict["endx"] = image_dict["startx"] + 55
+    # starty = 697468 + 10
+    image_dict["starty"] = 174377 - 10
+    image_dict["endy"] = image_dict["starty"] + 38
+    image_dict["tile_width"] = 256
+    image_dict["tile_height"] = 256
 
     width = (image_dict["endx"] - image_dict["startx"]) * image_dict["tile_width"]
     height = (image_dict["endy"] - image_dict["starty"]) * image_dict["tile_height"]
 
-    tiles = await download_tiles(image_dict)
+    if geotiff:
+        await download_geotiff(
+            image_dict,
+            output_path,
+            width,
+            height,
+            backend,
+            verify,
+            order,
+            budget,
+            shards,
+            refresh,
+        )
+        return
+
+    if len(image_dict["layers"]) > 1:
+        # Blend each cell as its layers arrive, into a single montage. The
+        # decoding and blending run in threads, off the downloads' loop.
+        montage = Image.new("RGB", (width, height))
+        blending = set()
+
+        def on_cell(cell: dict):
+            task = asyncio.create_task(
+                asyncio.to_thread(composite_cell, montage, cell),
+            )
+            blending.add(task)
+            task.add_done_callback(blending.discard)
+
+        tiles = await download_tiles(
+            image_dict,
+            backend,
+            verify,
+            on_cell,
+            order,
+            budget,
+            shards=shards,
+            refresh=refresh,
+        )
+        await asyncio.gather(*blending)
+        if tiles:
+            print()
+            report = save_image(montage, output_path)
+            print(
+                f"Composite of {len(image_dict['layers'])} layers "
+                f"saved to {output_path}: {describe(report)}",
+            )
+        return
+
+    tiles = await download_tiles(
+        image_dict,
+        backend,
+        verify,
+        None,
+        order,
+        budget,
+        shards=shards,
+        refresh=refresh,
+    )
 
     if tiles:
         print()
         print(f"Creating montage {output_path}")
-        montage = Image.new("RGB", (width, height))
-        for tile in tiles:
-            with Image.open(tile["file"]) as im:
-                montage.paste(im, (tile["x"], tile["y"]))
-        montage.save(output_path)
-        print(f"Montage saved to {output_path}")
+        montage = build_montage(width, height, tiles)
+        report = save_image(montage, output_path)
+        print(f"Montage saved to {output_path}: {describe(report)}")
 
 
 if __name__ == "__main__":
@@ -161,17 +484,81 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(prog="xyz2", usage="%(prog)s [options]")
     parser.add_argument(
         "--xyz",
-        help=("XYZ Json"),
-        default=("1940s.json"),
+        help=("XYZ Json, repeat to blend layers (bottom first)"),
+        action="append",
+    )
+    parser.add_argument(
+        "--opacity",
+        help="Opacity of each layer, bottom first (default 1.0)",
+        type=float,
+        nargs="+",
     )
     parser.add_argument("--output", help="Output filename")
+    parser.add_argument(
+        "--backend",
+        help="HTTP backend",
+        choices=BACKENDS,
+        default="httpx",
+    )
+    parser.add_argument(
+        "--geotiff",
+        help="Write a tiled, overviewed GeoTIFF (.tif) instead of a montage",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--verify",
+        help="Re-check cached tiles and refetch any that are corrupt",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--order",
+        help="Order to fetch tiles in",
+        choices=ORDERS,
+        default="column",
+    )
+    parser.add_argument(
+        "--seconds",
+        help="Stop fetching new tiles after this many seconds",
+        type=float,
+    )
+    parser.add_argument(
+        "--requests",
+        help="Stop fetching new tiles after this many requests",
+        type=int,
+    )
+    parser.add_argument(
+        "--shards",
+        help="Split the grid across this many worker processes",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--refresh",
+        help="Revalidate cached tiles with the server, refetching changed ones",
+        action="store_true",
+    )
     args = parser.parse_args()
     # Use provided manifest URL or default to example
-    xyzfile = args.xyz
+    xyzfiles = args.xyz or ["1940s.json"]
     if args.output:
         output_path = args.output
+    elif args.geotiff:
+        output_path = "output.tif"
     else:
         output_path = "output.jpg"
-    asyncio.run(main(xyzfile, output_path))
+    asyncio.run(
+        main(
+            xyzfiles,
+            output_path,
+            args.backend,
+            args.verify,
+            args.opacity,
+            args.geotiff,
+            args.order,
+            Budget(args.seconds, args.requests),
+            args.shards,
+            args.refresh,
+        ),
+    )
     total_slept_for = time.monotonic() - started_at
     print(f"workers took {total_slept_for:.2f} seconds")